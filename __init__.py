@@ -1,16 +1,29 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
 from trytond.pool import Pool
-from . import production
+from . import production, result, snapshot, stats, traceability
+from . import routes
+
+__all__ = ['register', 'routes']
 
 
 def register():
     Pool.register(
         production.Production,
+        production.Move,
         production.PrintProductionTraceabilityStart,
+        traceability.TraceabilityEdge,
+        traceability.Cron,
+        traceability.RebuildTraceabilityEdgeStart,
+        result.TraceabilityResult,
+        snapshot.TraceabilitySnapshot,
+        snapshot.TraceabilitySnapshotLine,
+        stats.TraceabilityStat,
+        stats.TraceabilityStatStage,
         module='production_traceability_report', type_='model')
     Pool.register(
         production.PrintProductionTraceability,
+        traceability.RebuildTraceabilityEdge,
         module='production_traceability_report', type_='wizard')
     Pool.register(
         production.PrintProductionTraceabilityReport,
@@ -1,52 +1,276 @@
 # The COPYRIGHT file at the top level of this repository contains the full
 # copyright notices and license terms.
-from datetime import datetime
+import base64
+import csv
+import hashlib
+import hmac
+import io
+import json
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from itertools import islice
 from collections import OrderedDict
+from urllib.parse import urlencode
+from sql import Cast, Literal, Null, With
+from sql import Window
+from sql.aggregate import Count, Max, Min, Sum
+from sql.conditionals import Case, NullIf
+from sql.functions import Abs, CurrentTimestamp
+from sql.operators import Exists
+from trytond import backend
+from trytond.cache import Cache
 from trytond.config import config
-from trytond.model import fields, ModelView
+from trytond.model import fields, Index, ModelView
 from trytond.pool import Pool, PoolMeta
 from trytond.pyson import Bool, Eval, If
-from trytond.wizard import Wizard, StateView, StateReport, Button
+from trytond.rpc import RPC
+from trytond.wizard import (Wizard, StateView, StateAction, StateReport,
+    StateTransition, Button)
+from trytond.tools import grouped_slice, reduce_ids
 from trytond.transaction import Transaction
 from trytond.modules.html_report.dominate_report import DominateReport
+from .stats import TraceabilityStats
 from dominate.util import raw
-from dominate.tags import (a, button, div, h1, i, script, strong, table, tbody,
-    td, th, thead, tr)
+from dominate.tags import (a, button, comment, div, h1, i, script, span,
+    strong, summary, table, tbody, td, th, thead, tr)
+from dominate.tags import details as details_tag
 
 
 BASE_URL = config.get('web', 'base_url')
+# 'sql' computes the report with a grouped query on the moves, 'edge' reads
+# it from the precomputed traceability edges of the done productions and
+# 'python' walks the moves of each production
+ENGINE = config.get('production_traceability_report', 'engine',
+    default='sql')
+# 'dom' builds the whole report body before rendering it, 'stream' renders it
+# one product section at a time and joins the rendered sections
+RENDER = config.get('production_traceability_report', 'render',
+    default='dom')
+# 'bootstrap' styles the report with Bootstrap and Font Awesome loaded from
+# their CDN, 'lite' renders a self-contained page with inline CSS and native
+# <details> elements
+HTML = config.get('production_traceability_report', 'html',
+    default='bootstrap')
+# 'lazy' only renders the product totals and fetches the details of each
+# product when it is expanded, it requires a secret to sign the requests
+DETAILS = config.get('production_traceability_report', 'details',
+    default='eager')
+DETAILS_PAGE_SIZE = config.getint('production_traceability_report',
+    'details_page_size', default=100)
+DETAILS_EXPIRATION = config.getint('production_traceability_report',
+    'details_expiration', default=24 * 60 * 60)
+SECRET = config.get('production_traceability_report', 'secret')
+# estimated size from which the report is generated in background, 0 always
+# generates it at once
+ASYNC_THRESHOLD = config.getint('production_traceability_report',
+    'async_threshold', default=0)
+# 0 disables the cache of the prepared reports, its size is set by the
+# production.traceability.report.prepare option of the cache section
+CACHE_SIZE = config.getint('production_traceability_report', 'cache_size',
+    default=20)
+# number of threads computing the first level of a report split in date
+# partitions, 0 computes it at once
+PARALLEL_WORKERS = config.getint('production_traceability_report',
+    'parallel_workers', default=0)
+PARTITION_DAYS = config.getint('production_traceability_report',
+    'partition_days', default=31)
+# relative difference of the consumption per unit produced of a production
+# with the overall one from which it is an outlier in the yield mode
+YIELD_TOLERANCE = config.getfloat('production_traceability_report',
+    'yield_tolerance', default=0.1)
+# number of rows read from the cursor at once by the csv and jsonl exports
+EXPORT_CHUNK_SIZE = config.getint('production_traceability_report',
+    'export_chunk_size', default=1000)
+# number of productions walked at once by the python engine, the records of
+# each chunk are released before reading the next one
+PRODUCTION_CHUNK_SIZE = config.getint('production_traceability_report',
+    'production_chunk_size', default=100)
+# maximum number of tuples returned by Production.traceability_lots
+LOTS_LIMIT = config.getint('production_traceability_report', 'lots_limit',
+    default=1000)
 _ZERO = 0.0
+# placeholder of the body in the document of the streamed reports
+_BODY_MARKER = comment('production_traceability_report body').render()
+LITE_CSS = """
+body{font:14px/1.4 sans-serif;color:#212529;margin:1em}
+a{color:#0056b3;text-decoration:none}
+table{width:100%;border-collapse:collapse}
+td,th{padding:.3em;border-top:1px solid #dee2e6;text-align:left;vertical-align:top}
+summary,.head{display:flex;padding:.3em;border-top:1px solid #dee2e6}
+summary{cursor:pointer;list-style:none}
+summary::-webkit-details-marker{display:none}
+summary::before{content:"\\25b8";width:1em}
+details[open]>summary::before{content:"\\25be"}
+summary>span:first-child,.head>span:first-child{flex:1}
+summary>span+span,.head>span+span,.lots td+td{width:15%;text-align:right}
+details>table{margin-left:1em;width:calc(100% - 1em)}
+.head{font-weight:bold}
+"""
+
+
+def iter_chunks(iterable, size):
+    '''
+    Yield the lists of at most size items of the iterable reading it only
+    as the chunks are consumed, unlike grouped_slice which reads it all
+    '''
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class TraceabilityEntry(object):
+    '''
+    Production entry of the traceability report.
+    It only keeps the ids of the production and UoMs so the entries of large
+    reports use as little memory as possible.
+    '''
+    __slots__ = ('production', 'quantity', 'consumption', 'quantity_uom',
+        'consumption_uom')
+
+    def __init__(self, production, quantity, consumption, quantity_uom,
+            consumption_uom):
+        self.production = production
+        self.quantity = quantity
+        self.consumption = consumption
+        self.quantity_uom = quantity_uom
+        self.consumption_uom = consumption_uom
 
 
 class Production(metaclass=PoolMeta):
     __name__ = 'production'
 
-    def traceability_report_data(self, requested_product, direction, lot=None):
-        Uom = Pool().get('product.uom')
+    @classmethod
+    def __setup__(cls):
+        super(Production, cls).__setup__()
+        cls.__rpc__.update({
+                'traceability_lots': RPC(readonly=True),
+                })
+        t = cls.__table__()
+        # Index of the productions changed since a snapshot
+        cls._sql_indexes.add(Index(t, (t.write_date, Index.Range())))
+
+    @classmethod
+    def touch_traceability(cls, productions):
+        '''
+        Set the write date of the productions whose moves are deleted so the
+        snapshots refresh them
+        '''
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice([p.id for p in productions]):
+            cursor.execute(*table.update(
+                    [table.write_uid, table.write_date],
+                    [transaction.user, CurrentTimestamp()],
+                    where=reduce_ids(table.id, sub_ids)))
+
+    @classmethod
+    def do(cls, productions):
+        pool = Pool()
+        Edge = pool.get('production.traceability.edge')
+        super(Production, cls).do(productions)
+        Edge.update_productions(productions)
+
+    @classmethod
+    def write(cls, *args):
+        Report = Pool().get('production.traceability.report', type='report')
+        super(Production, cls).write(*args)
+        Report.clear_cache()
+
+    @classmethod
+    def cancel(cls, productions):
+        pool = Pool()
+        Edge = pool.get('production.traceability.edge')
+        super(Production, cls).cancel(productions)
+        Edge.delete_productions(productions)
+
+    @classmethod
+    def traceability_lots(cls, lots, direction='forward', depth=1,
+            expiration_date=None, limit=None):
+        '''
+        Return the lots traced from the lot ids as tuples:
+            lot id, traced lot id, traced product id, production id,
+            quantity, expiration date, level
+        The lot id is the requested lot at the first level and the lot from
+        which the traced lot is reached at the next levels. Quantity is the
+        quantity of the traced lot in the production in the default UoM of
+        its product. With expiration_date only the lots that expire on or
+        after it, or without expiration, are returned. At most limit tuples,
+        bounded by the lots_limit option, are returned.
+        '''
+        pool = Pool()
+        Lot = pool.get('stock.lot')
+        Report = pool.get('production.traceability.report', type='report')
+        company_id = Transaction().context.get('company')
+        limit = min(limit or LOTS_LIMIT, LOTS_LIMIT)
+        has_expiration = 'expiration_date' in Lot._fields
+
+        roots = [(l['product'], l['id'])
+            for l in Lot.read(list(lots), ['product'])]
+        levels = {r: 0 for r in roots}
+        expirations = {}
+        result = []
+        rows = Report._iter_rows(direction, roots, depth or 1, None, None,
+            company_id)
+        try:
+            for chunk in iter_chunks(rows, EXPORT_CHUNK_SIZE):
+                chunk = [r for r in chunk if r[4] is not None]
+                lot_ids = {r[4] for r in chunk} - expirations.keys()
+                if has_expiration and lot_ids:
+                    for value in Lot.read(list(lot_ids), ['expiration_date']):
+                        expirations[value['id']] = value['expiration_date']
+                else:
+                    expirations.update(dict.fromkeys(lot_ids))
+                for (key_product, key_lot, production, product, lot,
+                        quantity, _) in chunk:
+                    level = levels[(key_product, key_lot)] + 1
+                    levels.setdefault((product, lot), level)
+                    expiration = expirations[lot]
+                    if (expiration_date and expiration
+                            and expiration < expiration_date):
+                        continue
+                    result.append((key_lot, lot, product, production,
+                            quantity, expiration, level))
+                    if len(result) >= limit:
+                        return result
+        finally:
+            rows.close()
+        return result
 
-        quantity = 0.0
+    def traceability_report_data(self, requested_product, direction, lot=None,
+            factors=None):
+        """
+        Return the traceability values by product and lot of the production.
+        factors is the table of UoM conversion factors by UoM ids pair which
+        can be shared between the productions of a report.
+        """
+        if factors is None:
+            factors = {}
+
+        quantities = []
         for move in getattr(self, 'outputs' if direction == 'backward' else 'inputs'):
             if move.product == requested_product:
-                quantity += Uom.compute_qty(move.unit, move.quantity, move.product.default_uom, False)
+                quantities.append(
+                    (move.unit, move.product.default_uom, move.quantity))
+        quantity = self._traceability_sum(quantities, factors)
 
         moves = {}
         for move in getattr(self, 'inputs' if direction == 'backward' else 'outputs'):
             product = move.product
             lot = move.lot or None if hasattr(move, 'lot') else None
-            mqty = Uom.compute_qty(
-                move.unit, move.quantity, move.product.default_uom, False)
-            if moves.get(product):
-                if moves[product].get(lot):
-                    moves[product][lot] += mqty
-                else:
-                    moves[product][lot] = mqty
-            else:
-                moves[product] = {lot: mqty}
+            moves.setdefault(product, {}).setdefault(lot, []).append(
+                (move.unit, product.default_uom, move.quantity))
 
         res = {}
         for product, values in moves.items():
             item = res.setdefault(product, {})
-            for lot, qty in values.items():
+            for lot, lot_quantities in values.items():
+                qty = self._traceability_sum(lot_quantities, factors)
                 if direction == 'backward':
                     traceability_quantity = quantity
                     traceability_consumption = qty
@@ -67,11 +291,343 @@ class Production(metaclass=PoolMeta):
                 item[lot] = vals
         return res
 
+    @classmethod
+    def _traceability_sum(cls, quantities, factors):
+        """
+        Return the sum of the (from UoM, to UoM, quantity) in the to UoM.
+        The quantities are summed by UoM pair and converted once with the
+        factor of the pair, which is computed only the first time.
+        """
+        Uom = Pool().get('product.uom')
+        pairs = {}
+        for from_uom, to_uom, quantity in quantities:
+            pairs.setdefault((from_uom, to_uom), []).append(quantity)
+        total = []
+        for (from_uom, to_uom), values in pairs.items():
+            key = (from_uom.id, to_uom.id)
+            if key not in factors:
+                factors[key] = Uom.compute_qty(from_uom, 1, to_uom, False)
+            total.append(math.fsum(values) * factors[key])
+        return math.fsum(total)
+
+    @classmethod
+    def _traceability_moves(cls, model='stock.move'):
+        """
+        Return the move table, the from item joined with the UoMs and the
+        expression of the move quantity in the default UoM of the product.
+        model can also be a BOM line which has the same columns.
+        """
+        pool = Pool()
+        Move = pool.get(model)
+        Product = pool.get('product.product')
+        Template = pool.get('product.template')
+        Uom = pool.get('product.uom')
+
+        move = Move.__table__()
+        product = Product.__table__()
+        template = Template.__table__()
+        from_uom = Uom.__table__()
+        to_uom = Uom.__table__()
+
+        from_ = (move
+            .join(product, condition=move.product == product.id)
+            .join(template, condition=product.template == template.id)
+            .join(from_uom, condition=move.unit == from_uom.id)
+            .join(to_uom, condition=template.default_uom == to_uom.id))
+        quantity = Case(
+            (from_uom.category == to_uom.category,
+                move.quantity * from_uom.factor / to_uom.factor),
+            else_=move.quantity)
+        return move, from_, quantity
+
+    @classmethod
+    def _traceability_matched(cls, direction, field, ids, from_date=None,
+            to_date=None, company=None, productions=None):
+        "Return the query of the productions matching the product or lot ids"
+        Move = Pool().get('stock.move')
+        move = Move.__table__()
+        production = cls.__table__()
+
+        side = ('production_output' if direction == 'backward'
+            else 'production_input')
+        # Unbounded dates are not filtered so the indexes stay selective
+        where = (getattr(move, field).in_(ids)
+            & (move.state == 'done')
+            & (getattr(move, side) != Null))
+        if from_date:
+            where &= (move.effective_date >= from_date)
+        if to_date:
+            where &= (move.effective_date <= to_date)
+        if productions is not None:
+            where &= reduce_ids(getattr(move, side), productions)
+        if company is not None:
+            where &= Exists(production.select(Literal(1),
+                    where=(production.id == getattr(move, side))
+                    & (production.company == company)))
+        lot = move.lot if field == 'lot' else Cast(Null, 'INTEGER')
+        return move.select(
+            getattr(move, side).as_('production'),
+            move.product.as_('product'),
+            lot.as_('lot'),
+            where=where,
+            distinct=True)
+
+    @classmethod
+    def traceability_query(cls, direction, products=None, lots=None,
+            from_date=None, to_date=None, company=None, productions=None):
+        '''
+        Return the query of the traceability rows of the productions that
+        consume (forward) or produce (backward) the product ids (any lot) or
+        the lot ids with the columns:
+            key_product, key_lot, production, product, lot, quantity,
+            requested_quantity
+        Key lot is NULL for the rows matched by product. Quantities are
+        converted to the default UoM of the product. The productions can be
+        limited to the production ids.
+        '''
+        Move = Pool().get('stock.move')
+        has_lot = hasattr(Move, 'lot')
+
+        if direction == 'backward':
+            side, other = 'production_output', 'production_input'
+        else:
+            side, other = 'production_input', 'production_output'
+
+        union = None
+        for field, ids in (('product', products), ('lot', lots)):
+            if not ids or (field == 'lot' and not has_lot):
+                continue
+            query = cls._traceability_matched(direction, field, ids,
+                from_date=from_date, to_date=to_date, company=company,
+                productions=productions)
+            union = query if union is None else union | query
+        assert union is not None, 'products or lots are required'
+        matched = With('production', 'product', 'lot', query=union)
+
+        # The requested moves are only read for the distinct matched
+        # productions and products so the lots do not multiply them
+        keys = matched.select(matched.production, matched.product,
+            distinct=True)
+        requested_move, requested_from, requested_quantity = (
+            cls._traceability_moves())
+        requested = (requested_from
+            .join(keys,
+                condition=(getattr(requested_move, side) == keys.production)
+                & (requested_move.product == keys.product))
+            .select(
+                keys.production.as_('production'),
+                keys.product.as_('product'),
+                Sum(requested_quantity).as_('quantity'),
+                group_by=[keys.production, keys.product]))
+
+        move, from_, quantity = cls._traceability_moves()
+        move_lot = move.lot if has_lot else Cast(Null, 'INTEGER')
+        columns = [matched.product, matched.lot, matched.production,
+            move.product]
+        if has_lot:
+            columns.append(move.lot)
+        return (from_
+            .join(matched,
+                condition=getattr(move, other) == matched.production)
+            .join(requested,
+                condition=((matched.production == requested.production)
+                    & (matched.product == requested.product)))
+            .select(
+                matched.product.as_('key_product'),
+                matched.lot.as_('key_lot'),
+                matched.production.as_('production'),
+                move.product.as_('product'),
+                move_lot.as_('lot'),
+                Sum(quantity).as_('quantity'),
+                requested.quantity.as_('requested_quantity'),
+                group_by=columns + [requested.quantity],
+                order_by=[matched.production] + columns[3:],
+                with_=[matched]))
+
+    @classmethod
+    def traceability_yield_query(cls, direction, query, tolerance):
+        '''
+        Return the query of the yield of the traceability query rows by key
+        product, key lot and product with the columns:
+            key_product, key_lot, product, productions, produced, consumed,
+            expected, expected_consumed, minimum, maximum, outliers
+        Produced is the quantity of the output product and consumed the
+        quantity of the input product. Expected is the consumption of the BOM
+        of the productions that have one and expected consumed their actual
+        consumption. Minimum and maximum are the consumptions per unit
+        produced of the productions and outliers the number of productions
+        for which it differs by more than tolerance of the overall one.
+        '''
+        pool = Pool()
+        BomInput = pool.get('production.bom.input')
+        BomOutput = pool.get('production.bom.output')
+        production = cls.__table__()
+
+        query.order_by = None
+        keys = [query.key_product, query.key_lot, query.production,
+            query.product]
+        # The requested quantity is repeated on each lot
+        per_production = query.select(
+            query.key_product.as_('key_product'),
+            query.key_lot.as_('key_lot'),
+            query.production.as_('production'),
+            query.product.as_('product'),
+            Sum(query.quantity).as_('quantity'),
+            Max(query.requested_quantity).as_('requested_quantity'),
+            group_by=keys)
+        if direction == 'backward':
+            produced = per_production.requested_quantity
+            consumed = per_production.quantity
+            input_product = per_production.product
+            output_product = per_production.key_product
+        else:
+            produced = per_production.quantity
+            consumed = per_production.requested_quantity
+            input_product = per_production.key_product
+            output_product = per_production.product
+
+        boms = []
+        for Line in [BomInput, BomOutput]:
+            line, from_, quantity = cls._traceability_moves(Line.__name__)
+            boms.append(from_.select(
+                    line.bom.as_('bom'),
+                    line.product.as_('product'),
+                    Sum(quantity).as_('quantity'),
+                    group_by=[line.bom, line.product]))
+        bom_input, bom_output = boms
+
+        window = Window([per_production.key_product, per_production.key_lot,
+                per_production.product])
+        overall = (Sum(consumed, window=window)
+            / NullIf(Sum(produced, window=window), 0))
+        rows = (per_production
+            .join(production,
+                condition=per_production.production == production.id)
+            .join(bom_input, 'LEFT',
+                condition=(bom_input.bom == production.bom)
+                & (bom_input.product == input_product))
+            .join(bom_output, 'LEFT',
+                condition=(bom_output.bom == production.bom)
+                & (bom_output.product == output_product))
+            .select(
+                per_production.key_product.as_('key_product'),
+                per_production.key_lot.as_('key_lot'),
+                per_production.product.as_('product'),
+                produced.as_('produced'),
+                consumed.as_('consumed'),
+                (produced * bom_input.quantity
+                    / NullIf(bom_output.quantity, 0)).as_('expected'),
+                (consumed / NullIf(produced, 0)).as_('ratio'),
+                overall.as_('overall')))
+
+        has_expected = rows.expected != Null
+        return rows.select(
+            rows.key_product.as_('key_product'),
+            rows.key_lot.as_('key_lot'),
+            rows.product.as_('product'),
+            Count(Literal('*')).as_('productions'),
+            Sum(rows.produced).as_('produced'),
+            Sum(rows.consumed).as_('consumed'),
+            Sum(rows.expected).as_('expected'),
+            Sum(Case((has_expected, rows.consumed), else_=Null)
+                ).as_('expected_consumed'),
+            Min(rows.ratio).as_('minimum'),
+            Max(rows.ratio).as_('maximum'),
+            Sum(Case(
+                    (Abs(rows.ratio - rows.overall)
+                        > Abs(rows.overall) * tolerance, 1),
+                    else_=0)).as_('outliers'),
+            group_by=[rows.key_product, rows.key_lot, rows.product],
+            order_by=[rows.key_product, rows.key_lot, rows.product])
+
+
+class Move(metaclass=PoolMeta):
+    __name__ = 'stock.move'
+
+    @classmethod
+    def __setup__(cls):
+        super(Move, cls).__setup__()
+        t = cls.__table__()
+        # Indexes of the traceability lookups: the done production moves of
+        # the products or lots in the dates, the moves of the productions
+        # by product and the production moves created or changed since a
+        # snapshot
+        for side in ['production_input', 'production_output']:
+            column = getattr(t, side)
+            where = (t.state == 'done') & (column != Null)
+            cls._sql_indexes.update({
+                    Index(t,
+                        (t.product, Index.Range()),
+                        (t.effective_date, Index.Range()),
+                        (column, Index.Range()),
+                        where=where),
+                    Index(t,
+                        (column, Index.Range()),
+                        (t.product, Index.Range()),
+                        where=column != Null),
+                    Index(t,
+                        (t.create_date, Index.Range()),
+                        where=column != Null),
+                    Index(t,
+                        (t.write_date, Index.Range()),
+                        where=column != Null),
+                    })
+            if hasattr(cls, 'lot'):
+                cls._sql_indexes.add(
+                    Index(t,
+                        (t.lot, Index.Range()),
+                        (t.effective_date, Index.Range()),
+                        (column, Index.Range()),
+                        where=where))
+
+    @classmethod
+    def _clear_traceability_cache(cls, moves):
+        "Clear the cached reports if any move is of a production"
+        Report = Pool().get('production.traceability.report', type='report')
+        # The reports also count the moves not done of the productions which
+        # consumed or produced the traced lots
+        if any(m.production_input or m.production_output for m in moves):
+            Report.clear_cache()
+            return True
+        return False
+
+    @classmethod
+    def create(cls, vlist):
+        moves = super(Move, cls).create(vlist)
+        cls._clear_traceability_cache(moves)
+        return moves
+
+    @classmethod
+    def write(cls, *args):
+        actions = iter(args)
+        moves = [m for moves, _ in zip(actions, actions) for m in moves]
+        # Before the write for the moves removed from a production
+        cleared = cls._clear_traceability_cache(moves)
+        super(Move, cls).write(*args)
+        if not cleared:
+            cls._clear_traceability_cache(moves)
+
+    @classmethod
+    def delete(cls, moves):
+        pool = Pool()
+        Production = pool.get('production')
+        cls._clear_traceability_cache(moves)
+        productions = {m.production_input or m.production_output
+            for m in moves} - {None}
+        super(Move, cls).delete(moves)
+        if productions:
+            Production.touch_traceability(list(productions))
+
 
 class PrintProductionTraceabilityStart(ModelView):
     'Print Production Traceability Start'
     __name__ = 'production.traceability.start'
-    product = fields.Many2One('product.product', 'Product', required=True)
+    product = fields.Many2One('product.product', 'Product',
+        states={
+            'required': ~Eval('products'),
+            })
+    products = fields.Many2Many('product.product', None, None, 'Products',
+        help='Other products to trace in the same report.')
     from_date = fields.Date('From Date',
         domain = [
             If(Bool(Eval('from_date')) & Bool(Eval('to_date')),
@@ -90,6 +646,29 @@ class PrintProductionTraceabilityStart(ModelView):
         ('backward', 'Backward'),
         ('forward', 'Forward'),
         ], 'Direction', required=True)
+    depth = fields.Integer('Depth', required=True,
+        domain=[
+            ('depth', '>=', 1),
+            ],
+        help='Number of production levels to follow. Levels after the first '
+        'one only follow the moves with lot.')
+    mode = fields.Selection([
+        ('traceability', 'Traceability'),
+        ('yield', 'Yield'),
+        ], 'Mode', required=True,
+        help='The yield mode summarizes by product the consumption per unit '
+        'produced of the productions against their BOM.')
+    output_format = fields.Selection([
+        ('html', 'HTML'),
+        ('csv', 'CSV'),
+        ('jsonl', 'JSON Lines'),
+        ('dot', 'DOT Graph'),
+        ('json', 'JSON Graph'),
+        ], 'Format', required=True,
+        help='The CSV and JSON Lines formats export one line per production '
+        'and lot.\n'
+        'The graph formats export the lots, products and productions as '
+        'nodes linked by the quantities moved.')
 
     @classmethod
     def __setup__(cls):
@@ -103,11 +682,25 @@ class PrintProductionTraceabilityStart(ModelView):
                 domain=[
                     ('product', '=', Eval('product')),
                     ])
+            cls.lots = fields.Many2Many('stock.lot', None, None, 'Lots',
+                help='Other lots to trace in the same report.')
 
     @staticmethod
     def default_direction():
         return 'backward'
 
+    @staticmethod
+    def default_depth():
+        return 1
+
+    @staticmethod
+    def default_mode():
+        return 'traceability'
+
+    @staticmethod
+    def default_output_format():
+        return 'html'
+
 
 class PrintProductionTraceability(Wizard):
     'Print Production Traceability'
@@ -115,9 +708,14 @@ class PrintProductionTraceability(Wizard):
     start = StateView('production.traceability.start',
         'production_traceability_report.print_production_traceability_start_view_form', [
             Button('Cancel', 'end', 'tryton-cancel'),
-            Button('Print', 'print_', 'tryton-print', default=True),
+            Button('Snapshot', 'snapshot', 'tryton-save'),
+            Button('Print', 'check', 'tryton-print', default=True),
             ])
+    check = StateTransition()
     print_ = StateReport('production.traceability.report')
+    queue = StateTransition()
+    snapshot = StateAction(
+        'production_traceability_report.act_traceability_snapshot')
 
     def default_start(self, fields):
         context = Transaction().context
@@ -126,25 +724,57 @@ class PrintProductionTraceability(Wizard):
         if context.get('active_model'):
             Model = Pool().get(context['active_model'])
             id = Transaction().context['active_id']
+            ids = [i for i in context.get('active_ids') or [] if i != id]
             if Model.__name__ == 'product.template':
                 template = Model(id)
                 if template.products:
                     res['product'] = template.products[0].id
+                res['products'] = [p.id for t in Model.browse([id] + ids)
+                    for p in t.products if p.id != res.get('product')]
             elif Model.__name__ == 'product.product':
                 res['product'] = id
+                res['products'] = ids
             elif Model.__name__ == 'stock.lot':
                 lot = Model(id)
                 res['lot'] = lot.id
                 res['product'] = lot.product.id
+                res['lots'] = ids
         return res
 
+    def transition_check(self):
+        Report = Pool().get('production.traceability.report', type='report')
+        if (ASYNC_THRESHOLD
+                and Report.estimate_size(self.get_report_data())
+                > ASYNC_THRESHOLD):
+            return 'queue'
+        return 'print_'
+
+    def transition_queue(self):
+        Result = Pool().get('production.traceability.result')
+        Result.enqueue(self.get_report_data())
+        return 'end'
+
     def do_print_(self, action):
+        return action, self.get_report_data()
+
+    def do_snapshot(self, action):
+        Snapshot = Pool().get('production.traceability.snapshot')
+        snapshot = Snapshot.create_from_data(self.get_report_data())
+        action['res_id'] = [snapshot.id]
+        action['views'].reverse()
+        return action, {}
+
+    def get_report_data(self):
         context = Transaction().context
         data = {
             'direction': self.start.direction,
+            'depth': self.start.depth,
+            'mode': self.start.mode,
+            'output_format': self.start.output_format,
             'from_date': self.start.from_date,
             'to_date': self.start.to_date,
-            'product': self.start.product.id,
+            'product': self.start.product.id if self.start.product else None,
+            'products': [p.id for p in self.start.products],
             'model': context.get('active_model'),
             'ids': context.get('active_ids') or [],
             }
@@ -154,18 +784,56 @@ class PrintProductionTraceability(Wizard):
             Lot = None
         if Lot:
             data['lot'] = self.start.lot.id if self.start.lot else None
-        return action, data
+            data['lots'] = [l.id for l in self.start.lots]
+        return data
 
 
 class PrintProductionTraceabilityReport(DominateReport):
     __name__ = 'production.traceability.report'
+    _prepare_cache = Cache('production.traceability.report.prepare',
+        context=False)
+
+    @classmethod
+    def get_roots(cls, data):
+        "Return the (product id, lot id) keys requested by the report data"
+        pool = Pool()
+        try:
+            Lot = pool.get('stock.lot')
+        except:
+            Lot = None
+
+        roots = []
+        if data.get('product'):
+            roots.append((data['product'], data.get('lot')))
+        for product in data.get('products') or []:
+            roots.append((product, None))
+        if Lot and data.get('lots'):
+            for lot in Lot.browse(data['lots']):
+                roots.append((lot.product.id, lot.id))
+        return list(OrderedDict.fromkeys(roots))
+
+    @classmethod
+    def get_name(cls, data):
+        "Return a name of the report data from its first products"
+        Product = Pool().get('product.product')
+        products = []
+        for product, _ in cls.get_roots(data):
+            if product not in products:
+                products.append(product)
+        name = ', '.join(p.rec_name for p in Product.browse(products[:3]))
+        if len(products) > 3:
+            name += ', ...'
+        return name
 
     @classmethod
     def prepare(cls, data):
+        """
+        Return the sections of the requested products and lots and the
+        parameters of the report
+        """
         pool = Pool()
         Product = pool.get('product.product')
         Company = pool.get('company.company')
-        Production = pool.get('production')
 
         try:
             Lot = pool.get('stock.lot')
@@ -177,118 +845,1164 @@ class PrintProductionTraceabilityReport(DominateReport):
         from_date = data.get('from_date') or datetime.min.date()
         to_date = data.get('to_date') or datetime.max.date()
 
-        requested_product = Product(data['product'])
         direction = data['direction']
-        lot = Lot(data['lot']) if data.get('lot') else None
+        roots = cls.get_roots(data)
 
         parameters = {}
         parameters['direction'] = direction
         parameters['from_date'] = from_date
         parameters['to_date'] = to_date
         parameters['show_date'] = bool(data.get('from_date'))
-        parameters['requested_product'] = requested_product
-        parameters['lot'] = lot
 
         # TODO get url from trytond.url issue8767
         if BASE_URL:
-            base_url = '%s/#%s' % (
-                BASE_URL, Transaction().database.name)
+            server_url = BASE_URL
         else:
-            base_url = '%s://%s/#%s' % (
+            server_url = '%s://%s' % (
                 t_context['_request']['scheme'],
                 t_context['_request']['http_host'],
-                Transaction().database.name
                 )
+        base_url = '%s/#%s' % (server_url, Transaction().database.name)
         parameters['base_url'] = base_url
         parameters['company'] = Company(company_id)
 
-        records = OrderedDict()
+        if data.get('mode') == 'yield':
+            parameters['mode'] = 'yield'
+            yields = cls._get_yields(direction, roots, data.get('from_date'),
+                data.get('to_date'), company_id)
+            sections = [{
+                    'product': Product(root[0]),
+                    'lot': Lot(root[1]) if Lot and root[1] else None,
+                    'records': OrderedDict(),
+                    'totals': {},
+                    'yields': yields.get(root, []),
+                    } for root in roots]
+            return sections, parameters
 
-        if direction == 'backward':
-            domain = [
-                    ('outputs.product', '=', requested_product),
-                    ('outputs.effective_date', '>=', from_date),
-                    ('outputs.effective_date', '<=', to_date),
-                    ('outputs.state', '=', 'done'),
-                    ('company', '=', company_id),
-                    ]
-            if lot:
-                domain += [('outputs.lot', '=', lot)]
+        depth = data.get('depth') or 1
+        lazy = bool(DETAILS == 'lazy' and SECRET and ENGINE != 'python'
+            and depth == 1 and not data.get('snapshot'))
+        key = (company_id, direction, tuple(roots), data.get('from_date'),
+            data.get('to_date'), depth, lazy, data.get('snapshot'))
+        cached = cls._prepare_cache.get(key) if CACHE_SIZE else None
+        if cached is not None:
+            results, tree = cached
         else:
+            if lazy:
+                results = cls._get_totals(direction, roots,
+                    data.get('from_date'), data.get('to_date'), company_id)
+                tree = {}
+            else:
+                tree = cls._build_nodes(direction, cls._traverse(direction,
+                        roots, depth, data.get('from_date'),
+                        data.get('to_date'), company_id,
+                        snapshot=data.get('snapshot')))
+                results = {r: tree.pop(r, (OrderedDict(), {}))
+                    for r in roots}
+            if CACHE_SIZE:
+                cls._prepare_cache.set(key, (results, tree))
+        parameters['tree'] = tree
+
+        sections = []
+        for root in roots:
+            records, totals = results.get(root, (OrderedDict(), {}))
+            section = {
+                'product': Product(root[0]),
+                'lot': Lot(root[1]) if Lot and root[1] else None,
+                'records': records,
+                'totals': totals,
+                }
+            if lazy:
+                section['details_url'] = '%s/%s/%s?%s' % (
+                    server_url, Transaction().database.name,
+                    'production_traceability/details',
+                    urlencode({'token': cls._details_token({
+                                    'direction': direction,
+                                    'product': root[0],
+                                    'lot': root[1],
+                                    'from_date': (data.get('from_date')
+                                        and data['from_date'].isoformat()),
+                                    'to_date': (data.get('to_date')
+                                        and data['to_date'].isoformat()),
+                                    'company': company_id,
+                                    'user': Transaction().user,
+                                    'database': Transaction().database.name,
+                                    'base_url': base_url,
+                                    'expire': (int(time.time())
+                                        + DETAILS_EXPIRATION),
+                                    })}))
+            sections.append(section)
+        return sections, parameters
+
+    @classmethod
+    def estimate_size(cls, data):
+        """
+        Return the estimated size of the report: the number of done moves of
+        the requested products and lots by the number of levels
+        """
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        move = Move.__table__()
+        production = Production.__table__()
+        cursor = Transaction().connection.cursor()
+
+        roots = cls.get_roots(data)
+        side = ('production_output' if data['direction'] == 'backward'
+            else 'production_input')
+        products = [p for p, l in roots if l is None]
+        lots = [l for p, l in roots if l is not None]
+        if not hasattr(Move, 'lot'):
+            products += [p for p, l in roots if l is not None]
+            lots = []
+        key_where = Literal(False)
+        if products:
+            key_where |= move.product.in_(products)
+        if lots:
+            key_where |= move.lot.in_(lots)
+        where = (key_where
+            & (move.state == 'done')
+            & (production.company == Transaction().context.get('company')))
+        if data.get('from_date'):
+            where &= (move.effective_date >= data['from_date'])
+        if data.get('to_date'):
+            where &= (move.effective_date <= data['to_date'])
+        cursor.execute(*move.join(production,
+                condition=getattr(move, side) == production.id
+                ).select(Count(Literal('*')), where=where))
+        count, = cursor.fetchone()
+        return count * (data.get('depth') or 1)
+
+    @classmethod
+    def clear_cache(cls):
+        "Clear the cached reports after a change of the traceability"
+        cls._prepare_cache.clear()
+
+    @classmethod
+    def _get_rows(cls, direction, keys, from_date, to_date, company_id,
+            productions=None):
+        """
+        Return the traceability rows of the (product id, lot id) keys:
+            key product, key lot, production, product, lot, quantity,
+            requested quantity
+        The rows can be limited to the production ids.
+        """
+        if ENGINE == 'python':
+            return cls._get_rows_python(direction, keys, from_date, to_date,
+                company_id, productions=productions)
+        return cls._get_rows_sql(direction, keys, from_date, to_date,
+            company_id, productions=productions)
+
+    @classmethod
+    def _get_partitions(cls, from_date, to_date):
+        "Return the date windows in which the rows are computed in parallel"
+        if (not PARALLEL_WORKERS or not from_date or not to_date
+                or backend.name == 'sqlite'):
+            return [(from_date, to_date)]
+        partitions = []
+        start = from_date
+        while start <= to_date:
+            end = min(start + timedelta(days=PARTITION_DAYS - 1), to_date)
+            partitions.append((start, end))
+            start = end + timedelta(days=1)
+        return partitions
+
+    @classmethod
+    def _get_rows_partitioned(cls, direction, keys, from_date, to_date,
+            company_id):
+        """
+        Return the rows of the keys computing each date partition in its own
+        read-only transaction in a pool of threads.
+        The rows are merged in the order of the partitions and sorted by
+        production. A production with requested moves in several partitions
+        is only kept once.
+        """
+        partitions = cls._get_partitions(from_date, to_date)
+        if len(partitions) == 1:
+            return cls._get_rows(direction, keys, from_date, to_date,
+                company_id)
+
+        transaction = Transaction()
+        args = (transaction.database.name, transaction.user,
+            dict(transaction.context), direction, list(keys), company_id)
+        with ThreadPoolExecutor(max_workers=PARALLEL_WORKERS) as executor:
+            results = list(executor.map(
+                    lambda p: cls._get_rows_partition(*args, *p),
+                    partitions))
+
+        rows, seen = [], set()
+        for partition_rows in results:
+            for row in partition_rows:
+                if row[:5] not in seen:
+                    seen.add(row[:5])
+                    rows.append(row)
+        rows.sort(key=lambda r: r[2])
+        return rows
+
+    @classmethod
+    def _get_rows_partition(cls, database_name, user, context, direction,
+            keys, company_id, from_date, to_date):
+        with Transaction().start(database_name, user, readonly=True,
+                context=context):
+            return list(cls._get_rows(direction, keys, from_date, to_date,
+                    company_id))
+
+    @classmethod
+    def _get_rows_python(cls, direction, keys, from_date, to_date,
+            company_id, productions=None):
+        """
+        Yield the rows walking the productions by chunks of
+        PRODUCTION_CHUNK_SIZE. The moves of each chunk are read at once and
+        the records and caches of a chunk are released before the next one
+        so the memory does not grow with the number of productions.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+        try:
+            Lot = pool.get('stock.lot')
+        except:
+            Lot = None
+        transaction = Transaction()
+
+        side = 'outputs' if direction == 'backward' else 'inputs'
+        factors = {}
+        for product_id, lot_id in keys:
             domain = [
-                    ('inputs.product', '=', requested_product),
-                    ('inputs.effective_date', '>=', from_date),
-                    ('inputs.effective_date', '<=', to_date),
-                    ('inputs.state', '=', 'done'),
+                    (side + '.product', '=', product_id),
+                    (side + '.state', '=', 'done'),
                     ('company', '=', company_id),
                     ]
-            if lot:
-                domain += [('inputs.lot', '=', lot)]
+            # Unbounded dates are not filtered so the indexes stay selective
+            if from_date:
+                domain += [(side + '.effective_date', '>=', from_date)]
+            if to_date:
+                domain += [(side + '.effective_date', '<=', to_date)]
+            if Lot and lot_id:
+                domain += [(side + '.lot', '=', lot_id)]
+            if productions is not None:
+                domain += [('id', 'in', productions)]
+            production_ids = [p.id for p in Production.search(domain)]
+
+            for sub_ids in grouped_slice(production_ids,
+                    PRODUCTION_CHUNK_SIZE):
+                # New records for each chunk so the previous ones and their
+                # cache are released
+                requested_product = Product(product_id)
+                lot = Lot(lot_id) if Lot and lot_id else None
+                chunk = Production.browse(list(sub_ids))
+                moves = Move.browse([m.id for p in chunk
+                        for m in p.inputs + p.outputs])
+                # Read the moves of the chunk and their products at once
+                for move in moves:
+                    move.product.default_uom
+                for production in chunk:
+                    res = production.traceability_report_data(
+                        requested_product, direction, lot, factors=factors)
+                    for product, values in res.items():
+                        for move_lot, v in values.items():
+                            if direction == 'backward':
+                                quantity = v['traceability_consumption']
+                                requested = v['traceability_quantity']
+                            else:
+                                quantity = v['traceability_quantity']
+                                requested = v['traceability_consumption']
+                            yield (product_id, lot_id, production.id,
+                                product.id, move_lot.id if move_lot else None,
+                                quantity, requested)
+                transaction.cache.clear()
+
+    @classmethod
+    def _get_queries(cls, direction, keys, from_date, to_date, company_id,
+            productions=None):
+        "Yield the traceability queries of the (product id, lot id) keys"
+        pool = Pool()
+        if ENGINE == 'edge':
+            Model = pool.get('production.traceability.edge')
+        else:
+            Model = pool.get('production')
+
+        in_max = Transaction().database.IN_MAX
+        for sub_keys in grouped_slice(keys, in_max):
+            sub_keys = list(sub_keys)
+            yield Model.traceability_query(direction,
+                products=[p for p, l in sub_keys if l is None],
+                lots=[l for p, l in sub_keys if l is not None],
+                from_date=from_date, to_date=to_date, company=company_id,
+                productions=productions)
+
+    @classmethod
+    def _get_rows_sql(cls, direction, keys, from_date, to_date, company_id,
+            productions=None):
+        connection = Transaction().connection
+        for query in cls._get_queries(direction, keys, from_date, to_date,
+                company_id, productions=productions):
+            if backend.name == 'postgresql':
+                # Use a server side cursor to not fetch all the rows at once
+                cursor = connection.cursor('production_traceability')
+                cursor.itersize = EXPORT_CHUNK_SIZE
+            else:
+                cursor = connection.cursor()
+            try:
+                cursor.execute(*query)
+                yield from cursor
+            finally:
+                cursor.close()
+
+    @classmethod
+    def _get_totals(cls, direction, roots, from_date, to_date, company_id):
+        """
+        Return the records without details and the totals of each root key
+        """
+        cursor = Transaction().connection.cursor()
+
+        rows = []
+        with TraceabilityStats.stage('aggregation'):
+            for query in cls._get_queries(direction, roots, from_date,
+                    to_date, company_id):
+                query.order_by = None
+                cursor.execute(*query.select(
+                        query.key_product,
+                        query.key_lot,
+                        query.product,
+                        Sum(query.quantity),
+                        Sum(query.requested_quantity),
+                        group_by=[query.key_product, query.key_lot,
+                            query.product],
+                        order_by=[query.product]))
+                rows.extend(cursor)
+            TraceabilityStats.add_rows(len(rows))
+
+        uoms = cls._get_default_uoms(
+            {r[0] for r in roots} | {r[2] for r in rows})
+        results = {}
+        for key_product, key_lot, product, qty, quantity in rows:
+            records, totals = results.setdefault((key_product, key_lot),
+                (OrderedDict(), {}))
+            requested_uom = uoms[key_product]
+            records[product] = OrderedDict()
+            if direction == 'backward':
+                totals[product] = {
+                    'quantity': quantity,
+                    'consumption': qty,
+                    'quantity_uom': requested_uom,
+                    'consumption_uom': uoms[product],
+                    }
+            else:
+                totals[product] = {
+                    'quantity': qty,
+                    'consumption': quantity,
+                    'quantity_uom': uoms[product],
+                    'consumption_uom': requested_uom,
+                    }
+        return results
+
+    @classmethod
+    def _get_yields(cls, direction, roots, from_date, to_date, company_id):
+        "Return the yield values by product of each root key"
+        pool = Pool()
+        Production = pool.get('production')
+        cursor = Transaction().connection.cursor()
+
+        rows = []
+        with TraceabilityStats.stage('aggregation'):
+            for query in cls._get_queries(direction, roots, from_date,
+                    to_date, company_id):
+                cursor.execute(*Production.traceability_yield_query(
+                        direction, query, YIELD_TOLERANCE))
+                rows.extend(cursor)
+            TraceabilityStats.add_rows(len(rows))
+
+        uoms = cls._get_default_uoms(
+            {r[0] for r in rows} | {r[2] for r in rows})
+        results = {}
+        for (key_product, key_lot, product, productions, produced, consumed,
+                expected, expected_consumed, minimum, maximum,
+                outliers) in rows:
+            if direction == 'backward':
+                produced_uom, consumed_uom = uoms[key_product], uoms[product]
+            else:
+                produced_uom, consumed_uom = uoms[product], uoms[key_product]
+            results.setdefault((key_product, key_lot), []).append({
+                    'product': product,
+                    'productions': productions,
+                    'produced': produced,
+                    'produced_uom': produced_uom,
+                    'consumed': consumed,
+                    'consumed_uom': consumed_uom,
+                    'expected': expected,
+                    'expected_consumed': expected_consumed,
+                    'minimum': minimum,
+                    'maximum': maximum,
+                    'outliers': outliers,
+                    })
+        return results
+
+    @classmethod
+    def _details_signature(cls, payload):
+        return hmac.new(SECRET.encode('utf-8'), payload.encode('utf-8'),
+            hashlib.sha256).hexdigest()
+
+    @classmethod
+    def _details_token(cls, data):
+        "Return the signed token of the details request data"
+        payload = base64.urlsafe_b64encode(
+            json.dumps(data, sort_keys=True).encode('utf-8')).decode('ascii')
+        return '%s.%s' % (payload, cls._details_signature(payload))
+
+    @classmethod
+    def details_data(cls, token):
+        "Return the data of the signed token or raise ValueError"
+        payload, _, signature = token.rpartition('.')
+        if (not SECRET or not payload
+                or not hmac.compare_digest(
+                    signature, cls._details_signature(payload))):
+            raise ValueError('Invalid token')
+        data = json.loads(base64.urlsafe_b64decode(payload))
+        if data['expire'] < time.time():
+            raise ValueError('Expired token')
+        return data
+
+    @classmethod
+    def details(cls, token, product_id, offset=0):
+        "Return the HTML of a page of the details of the product"
+        cursor = Transaction().connection.cursor()
+        data = cls.details_data(token)
+
+        direction = data['direction']
+        root = (data['product'], data['lot'])
+        from_date = data['from_date'] and date.fromisoformat(data['from_date'])
+        to_date = data['to_date'] and date.fromisoformat(data['to_date'])
+
+        query, = cls._get_queries(direction, [root], from_date, to_date,
+            data['company'])
+        query.order_by = None
+        cursor.execute(*query.select(
+                where=query.product == product_id,
+                order_by=[query.lot, query.production],
+                limit=DETAILS_PAGE_SIZE + 1,
+                offset=offset))
+        rows = cursor.fetchall()
+        more = len(rows) > DETAILS_PAGE_SIZE
+        rows = rows[:DETAILS_PAGE_SIZE]
+
+        records, totals = cls._build_nodes(direction, {root: rows}).get(
+            root, ({}, {}))
+        parameters = {
+            'base_url': data['base_url'],
+            'tree': {},
+            }
+        cls.prefetch([{'records': records, 'totals': totals}], parameters)
+        fragment = div()
+        with fragment:
+            for product, values in records.items():
+                cls._draw_table('product-%s' % product, values,
+                    parameters, product=product, collapse=False)
+            if more:
+                a('Next page', cls=('next-page' if HTML == 'lite'
+                        else 'next-page btn btn-link btn-sm'),
+                    href='?%s' % urlencode({
+                            'token': token,
+                            'product': product_id,
+                            'offset': offset + DETAILS_PAGE_SIZE,
+                            }))
+        return fragment.render()
+
+    @classmethod
+    def _traverse(cls, direction, roots, depth, from_date, to_date,
+            company_id, snapshot=None):
+        """
+        Return the traceability rows by (product id, lot id) node expanding
+        the roots breadth-first up to depth levels.
+        The date window only applies to the first level and the next levels
+        only follow the lots. Each node is only expanded once so shared
+        intermediates and rework loops are not queried again.
+        """
+        tree = OrderedDict()
+        count = 0
+        with TraceabilityStats.stage('aggregation'):
+            for row in cls._iter_rows(direction, roots, depth, from_date,
+                    to_date, company_id, snapshot=snapshot):
+                tree.setdefault((row[0], row[1]), []).append(row)
+                count += 1
+            TraceabilityStats.add_rows(count)
+        return tree
+
+    @classmethod
+    def _iter_rows(cls, direction, roots, depth, from_date, to_date,
+            company_id, snapshot=None):
+        """
+        Yield the traceability rows of the roots level by level or the rows
+        stored by the snapshot id
+        """
+        if snapshot is not None:
+            Snapshot = Pool().get('production.traceability.snapshot')
+            yield from Snapshot(snapshot).iter_rows()
+            return
+        visited = set(roots)
+        frontier = list(roots)
+        level = 0
+        while frontier and level < depth:
+            if level:
+                from_date = to_date = None
+            next_frontier = []
+            for row in cls._get_rows_partitioned(direction, frontier,
+                    from_date, to_date, company_id):
+                yield row
+                child = (row[3], row[4])
+                if child[1] is not None and child not in visited:
+                    visited.add(child)
+                    next_frontier.append(child)
+            frontier = next_frontier
+            level += 1
+
+    @classmethod
+    def export(cls, data):
+        """
+        Yield the lines of the csv or jsonl export of the report data.
+        The rows are read from the cursor by chunks and never kept all
+        together so the memory used does not depend on the size of the
+        export.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Production = pool.get('production')
+        Uom = pool.get('product.uom')
+        try:
+            Lot = pool.get('stock.lot')
+        except:
+            Lot = None
+
+        output_format = data['output_format']
+        direction = data['direction']
+        company_id = Transaction().context.get('company')
+        if output_format in {'dot', 'json'}:
+            yield from cls._export_graph(data)
+            return
+        if data.get('mode') == 'yield':
+            yield from cls._export_yields(data)
+            return
+        columns = ['requested_product', 'requested_lot', 'product', 'lot',
+            'production', 'quantity', 'quantity_uom', 'consumption',
+            'consumption_uom']
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        if output_format == 'csv':
+            writer.writerow(columns)
+
+        # The products and UoMs are bounded by the catalog so they are kept
+        # between chunks
+        products, uoms, symbols = {}, {}, {}
+        rows = cls._iter_rows(direction, cls.get_roots(data),
+            data.get('depth') or 1, data.get('from_date'),
+            data.get('to_date'), company_id, snapshot=data.get('snapshot'))
+        for chunk in iter_chunks(rows, EXPORT_CHUNK_SIZE):
+            chunk = list(chunk)
+            TraceabilityStats.add_rows(len(chunk))
+            product_ids = ({r[0] for r in chunk} | {r[3] for r in chunk}
+                ) - products.keys()
+            if product_ids:
+                for sub_ids in grouped_slice(product_ids):
+                    for value in Product.read(list(sub_ids),
+                            ['rec_name', 'default_uom']):
+                        products[value['id']] = value['rec_name']
+                        uoms[value['id']] = value['default_uom']
+                uom_ids = set(uoms.values()) - symbols.keys()
+                for value in Uom.read(list(uom_ids), ['symbol']):
+                    symbols[value['id']] = value['symbol']
+            lots = {}
+            lot_ids = {r[1] for r in chunk} | {r[4] for r in chunk}
+            lot_ids.discard(None)
+            if Lot and lot_ids:
+                for value in Lot.read(list(lot_ids), ['rec_name']):
+                    lots[value['id']] = value['rec_name']
+            productions = {v['id']: v['rec_name'] for v in Production.read(
+                    list({r[2] for r in chunk}), ['rec_name'])}
+
+            for (key_product, key_lot, production, product, lot, qty,
+                    quantity) in chunk:
+                if direction == 'backward':
+                    quantity_uom = uoms[key_product]
+                    consumption, consumption_uom = qty, uoms[product]
+                else:
+                    quantity, consumption = qty, quantity
+                    quantity_uom = uoms[product]
+                    consumption_uom = uoms[key_product]
+                values = [products[key_product], lots.get(key_lot),
+                    products[product], lots.get(lot),
+                    productions[production], quantity,
+                    symbols[quantity_uom], consumption,
+                    symbols[consumption_uom]]
+                if output_format == 'csv':
+                    writer.writerow(values)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, values)),
+                            separators=(',', ':')))
+                    buffer.write('\n')
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        if buffer.tell():
+            yield buffer.getvalue()
+
+    @classmethod
+    def _add_entry(cls, records, totals, product, lot, entry):
+        records.setdefault(product, OrderedDict()).setdefault(
+            lot, []).append(entry)
+        if product not in totals:
+            totals[product] = {
+                'quantity': 0.0,
+                'consumption': 0.0,
+                'quantity_uom': entry.quantity_uom,
+                'consumption_uom': entry.consumption_uom,
+                }
+        totals[product]['quantity'] += entry.quantity
+        totals[product]['consumption'] += entry.consumption
+
+    @classmethod
+    def _get_default_uoms(cls, product_ids):
+        "Return the default UoM id of each product id"
+        Product = Pool().get('product.product')
+        uoms = {}
+        for sub_ids in grouped_slice(product_ids):
+            for value in Product.read(list(sub_ids), ['default_uom']):
+                uoms[value['id']] = value['default_uom']
+        return uoms
 
-        productions = Production.search(domain)
+    @classmethod
+    def _build_nodes(cls, direction, tree):
+        """
+        Return the records and totals of each node of the tree keyed by ids
+        """
+        with TraceabilityStats.stage('build'):
+            product_ids = set()
+            for rows in tree.values():
+                for row in rows:
+                    product_ids.update((row[0], row[3]))
+            uoms = cls._get_default_uoms(product_ids)
+
+            nodes = OrderedDict()
+            for node, rows in tree.items():
+                records = OrderedDict()
+                totals = {}
+                requested_uom = uoms[node[0]]
+                for _, _, production, product, lot, qty, quantity in rows:
+                    if direction == 'backward':
+                        entry = TraceabilityEntry(production, quantity, qty,
+                            requested_uom, uoms[product])
+                    else:
+                        entry = TraceabilityEntry(production, qty, quantity,
+                            uoms[product], requested_uom)
+                    cls._add_entry(records, totals, product, lot, entry)
+                nodes[node] = (records, totals)
+        return nodes
+
+    @classmethod
+    def prefetch(cls, sections, parameters):
+        """
+        Read at once the values rendered of the products, lots, productions
+        and UoMs of the sections and the tree and store them in the
+        parameters as dictionaries by model name and id
+        """
+        pool = Pool()
+        try:
+            Lot = pool.get('stock.lot')
+        except:
+            Lot = None
+
+        ids = {
+            'product.product': set(),
+            'stock.lot': set(),
+            'production': set(),
+            'product.uom': set(),
+            }
+
+        def collect(records, totals):
+            for product, values in records.items():
+                ids['product.product'].add(product)
+                for lot, entries in values.items():
+                    if lot:
+                        ids['stock.lot'].add(lot)
+                    for entry in entries:
+                        ids['production'].add(entry.production)
+                        ids['product.uom'].update((
+                                entry.quantity_uom, entry.consumption_uom))
+            for product_totals in totals.values():
+                ids['product.uom'].update((
+                        product_totals['quantity_uom'],
+                        product_totals['consumption_uom']))
+
+        for section in sections:
+            collect(section['records'], section['totals'])
+            for values in section.get('yields', []):
+                ids['product.product'].add(values['product'])
+                ids['product.uom'].update((
+                        values['produced_uom'], values['consumed_uom']))
+        for node_records, node_totals in (parameters.get('tree') or {}
+                ).values():
+            collect(node_records, node_totals)
+
+        fields_names = {
+            'product.product': ['rec_name'],
+            'stock.lot': ['rec_name'],
+            'production': ['rec_name'],
+            'product.uom': ['symbol'],
+            }
+        if Lot and 'expiration_date' in Lot._fields:
+            fields_names['stock.lot'].append('expiration_date')
+
+        prefetched = parameters['prefetched'] = {}
+        for model, model_ids in ids.items():
+            values = prefetched[model] = {}
+            if not model_ids or (model == 'stock.lot' and not Lot):
+                continue
+            Model = pool.get(model)
+            for sub_ids in grouped_slice(model_ids):
+                for value in Model.read(list(sub_ids), fields_names[model]):
+                    values[value['id']] = value
 
-        records = {}
-        totals = {}
-        for production in productions:
-            res = production.traceability_report_data(requested_product,
-                    direction, lot)
+    @classmethod
+    def _export_graph(cls, data):
+        """
+        Yield the DOT or JSON node-link graph of the report data.
+        The edges follow the material: from the input lots (or products
+        without lot) to the productions and from the productions to the
+        output lots. They are written as the rows are read and the nodes are
+        written at the end with their labels.
+        """
+        pool = Pool()
+        Product = pool.get('product.product')
+        Uom = pool.get('product.uom')
+        try:
+            Lot = pool.get('stock.lot')
+        except:
+            Lot = None
+
+        dot = data['output_format'] == 'dot'
+        direction = data['direction']
+        company_id = Transaction().context.get('company')
+
+        def item(product, lot):
+            return ('stock.lot', lot) if lot else ('product.product', product)
 
-            for key, values in res.items():
-                if not records.get(key):
-                    records.setdefault(key, {})
+        def node_id(node):
+            return '%s:%s' % (node[0].split('.')[-1], node[1])
 
-                for k, v in values.items():
-                    # records
-                    if k in records[key]:
-                        records[key][k].append(v)
+        buffer = io.StringIO()
+        if dot:
+            buffer.write('digraph traceability {\n')
+        else:
+            buffer.write('{"directed":true,"multigraph":false,"links":[')
+        nodes = {'product.product': set(), 'stock.lot': set(),
+            'production': set()}
+        uoms, symbols = {}, {}
+        production_edges, last_production = set(), None
+        first = True
+        rows = cls._iter_rows(direction, cls.get_roots(data),
+            data.get('depth') or 1, data.get('from_date'),
+            data.get('to_date'), company_id, snapshot=data.get('snapshot'))
+        for chunk in iter_chunks(rows, EXPORT_CHUNK_SIZE):
+            chunk = list(chunk)
+            TraceabilityStats.add_rows(len(chunk))
+            product_ids = ({r[0] for r in chunk} | {r[3] for r in chunk}
+                ) - uoms.keys()
+            if product_ids:
+                for sub_ids in grouped_slice(product_ids):
+                    for value in Product.read(list(sub_ids),
+                            ['default_uom']):
+                        uoms[value['id']] = value['default_uom']
+                uom_ids = set(uoms.values()) - symbols.keys()
+                for value in Uom.read(list(uom_ids), ['symbol']):
+                    symbols[value['id']] = value['symbol']
+
+            for (key_product, key_lot, production, product, lot, qty,
+                    quantity) in chunk:
+                # The rows of a production are consecutive
+                if production != last_production:
+                    production_edges.clear()
+                    last_production = production
+                production_node = ('production', production)
+                key_node = item(key_product, key_lot)
+                other_node = item(product, lot)
+                if direction == 'backward':
+                    edges = [
+                        (production_node, key_node, quantity, key_product),
+                        (other_node, production_node, qty, product),
+                        ]
+                else:
+                    edges = [
+                        (key_node, production_node, quantity, key_product),
+                        (production_node, other_node, qty, product),
+                        ]
+                for source, target, weight, weight_product in edges:
+                    if (source, target) in production_edges:
+                        continue
+                    production_edges.add((source, target))
+                    for model, id_ in (source, target):
+                        nodes[model].add(id_)
+                    label = '%s %s' % (weight, symbols[uoms[weight_product]])
+                    if dot:
+                        buffer.write('  "%s" -> "%s" [weight=%s, label="%s"];'
+                            '\n' % (node_id(source), node_id(target), weight,
+                                label))
                     else:
-                        records[key][k] = [v]
+                        if not first:
+                            buffer.write(',')
+                        buffer.write(json.dumps({
+                                    'source': node_id(source),
+                                    'target': node_id(target),
+                                    'weight': weight,
+                                    'label': label,
+                                    }, separators=(',', ':')))
+                    first = False
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
 
-                    # totals
-                    if not key in totals:
-                        item = totals.setdefault(key, {})
-                        item.setdefault('quantity', 0.0)
-                        item.setdefault('consumption', 0.0)
-                        item.setdefault('quantity_uom', v['traceability_quantity_uom'])
-                        item.setdefault('consumption_uom', v['traceability_consumption_uom'])
-                    totals[key]['quantity'] += v['traceability_quantity']
-                    totals[key]['consumption'] += v['traceability_consumption']
+        if not dot:
+            buffer.write('],"nodes":[')
+        first = True
+        for model, ids in nodes.items():
+            if not ids or (model == 'stock.lot' and not Lot):
+                continue
+            Model = pool.get(model)
+            for sub_ids in grouped_slice(sorted(ids)):
+                for value in Model.read(list(sub_ids), ['rec_name']):
+                    node = (model, value['id'])
+                    if dot:
+                        buffer.write('  "%s" [label="%s", shape=%s];\n' % (
+                                node_id(node),
+                                value['rec_name'].replace('"', '\\"'),
+                                'box' if model == 'production' else 'ellipse'))
+                    else:
+                        if not first:
+                            buffer.write(',')
+                        buffer.write(json.dumps({
+                                    'id': node_id(node),
+                                    'type': model,
+                                    'label': value['rec_name'],
+                                    }, separators=(',', ':')))
+                    first = False
+                yield buffer.getvalue()
+                buffer.seek(0)
+                buffer.truncate()
+        buffer.write('}\n' if dot else ']}\n')
+        yield buffer.getvalue()
 
-        return records, totals, parameters
+    @classmethod
+    def _export_yields(cls, data):
+        "Yield the lines of the csv or jsonl export of the yields"
+        sections, parameters = cls.prepare(data)
+        cls.prefetch(sections, parameters)
+        prefetched = parameters['prefetched']
+        products = prefetched['product.product']
+        uoms = prefetched['product.uom']
+        columns = ['requested_product', 'requested_lot', 'product',
+            'productions', 'produced', 'produced_uom', 'consumed',
+            'consumed_uom', 'minimum', 'maximum', 'expected', 'variance',
+            'outliers']
+
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        if data['output_format'] == 'csv':
+            writer.writerow(columns)
+        for section in sections:
+            for values in section['yields']:
+                row = [section['product'].rec_name,
+                    section['lot'].rec_name if section['lot'] else None,
+                    products[values['product']]['rec_name'],
+                    values['productions'],
+                    values['produced'],
+                    uoms[values['produced_uom']]['symbol'],
+                    values['consumed'],
+                    uoms[values['consumed_uom']]['symbol'],
+                    values['minimum'],
+                    values['maximum'],
+                    values['expected'],
+                    cls._yield_variance(values),
+                    values['outliers']]
+                if data['output_format'] == 'csv':
+                    writer.writerow(row)
+                else:
+                    buffer.write(json.dumps(dict(zip(columns, row)),
+                            separators=(',', ':')))
+                    buffer.write('\n')
+        yield buffer.getvalue()
 
     @classmethod
-    def _draw_table(cls, key, values, parameters):
+    def _draw_table(cls, key, values, parameters, product=None,
+            rendered=None, collapse=True):
+        if HTML == 'lite':
+            return cls._draw_table_lite(values, parameters, product=product,
+                rendered=rendered)
         render = cls.render
-        details_table = table(cls='table collapse multi-collapse', id=key)
+        tree = parameters.get('tree') or {}
+        prefetched = parameters['prefetched']
+        lots = prefetched['stock.lot']
+        productions = prefetched['production']
+        uoms = prefetched['product.uom']
+        if rendered is None:
+            rendered = set()
+        if collapse:
+            details_table = table(cls='table collapse multi-collapse', id=key)
+        else:
+            details_table = table(cls='table')
         with details_table:
             with tbody():
                 for lot, entries in values.items():
                     with tr():
                         with td(colspan='3'):
                             strong('Lot: %s Expiration_date: %s' % (
-                                lot.rec_name if lot else '--',
-                                lot.expiration_date if lot else '--'))
+                                lots[lot]['rec_name'] if lot else '--',
+                                lots[lot].get('expiration_date')
+                                if lot else '--'))
+                    node = (product, lot) if product and lot else None
+                    if node in tree and node not in rendered:
+                        rendered.add(node)
+                        records, totals = tree[node]
+                        with tr():
+                            with td(colspan='3') as node_cell:
+                                node_cell.add(cls._draw_detail(records,
+                                        totals, parameters,
+                                        prefix='%s-%s' % (key, lot),
+                                        rendered=rendered))
                     for entry in entries:
-                        production = entry['production']
+                        production_name = productions[entry.production][
+                            'rec_name']
                         with tr():
                             with td(width='50%'):
-                                a(production.rec_name,
+                                a(production_name,
                                     href='%s/model/production/%s;name="%s"' % (
                                         parameters['base_url'],
-                                        production.id,
-                                        production.rec_name))
+                                        entry.production,
+                                        production_name))
                             td('%s %s' % (
-                                render(entry['traceability_quantity'], digits=4),
-                                entry['traceability_quantity_uom'].symbol),
+                                render(entry.quantity, digits=4),
+                                uoms[entry.quantity_uom]['symbol']),
                                 width='10%')
                             td('%s %s' % (
-                                render(entry['traceability_consumption'], digits=4),
-                                entry['traceability_consumption_uom'].symbol),
+                                render(entry.consumption, digits=4),
+                                uoms[entry.consumption_uom]['symbol']),
                                 width='10%')
         return details_table
 
+    @classmethod
+    def _draw_table_lite(cls, values, parameters, product=None,
+            rendered=None):
+        "Return the lot details table of the lite HTML"
+        render = cls.render
+        tree = parameters.get('tree') or {}
+        prefetched = parameters['prefetched']
+        lots = prefetched['stock.lot']
+        productions = prefetched['production']
+        uoms = prefetched['product.uom']
+        if rendered is None:
+            rendered = set()
+        details_table = table(cls='lots')
+        with details_table:
+            for lot, entries in values.items():
+                tr(th('Lot: %s Expiration_date: %s' % (
+                            lots[lot]['rec_name'] if lot else '--',
+                            lots[lot].get('expiration_date')
+                            if lot else '--'),
+                        colspan='3'))
+                node = (product, lot) if product and lot else None
+                if node in tree and node not in rendered:
+                    rendered.add(node)
+                    records, totals = tree[node]
+                    tr(td(cls._draw_detail(records, totals, parameters,
+                                rendered=rendered),
+                            colspan='3'))
+                for entry in entries:
+                    production_name = productions[entry.production][
+                        'rec_name']
+                    tr(td(a(production_name,
+                                href='%s/model/production/%s;name="%s"' % (
+                                    parameters['base_url'],
+                                    entry.production,
+                                    production_name))),
+                        td('%s %s' % (
+                                render(entry.quantity, digits=4),
+                                uoms[entry.quantity_uom]['symbol'])),
+                        td('%s %s' % (
+                                render(entry.consumption, digits=4),
+                                uoms[entry.consumption_uom]['symbol'])))
+        return details_table
+
+    @classmethod
+    def _draw_detail(cls, records, totals, parameters, prefix='product',
+            rendered=None):
+        """
+        Return the table with the totals of each product and its collapsible
+        lot details. The lots expanded by the tree are drawn as nested
+        details only the first time they appear.
+        """
+        if HTML == 'lite':
+            return cls._draw_detail_lite(records, totals, parameters,
+                prefix=prefix, rendered=rendered)
+        if rendered is None:
+            rendered = set()
+        detail_table = table(cls='table',
+            id='detail' if prefix == 'product' else 'detail-%s' % prefix)
+        with detail_table:
+            with thead():
+                with tr():
+                    th('Product', scope='col', width='50%')
+                    th('Quantity', scope='col', width='10%')
+                    th('Consumption', scope='col', width='10%')
+            with tbody() as detail_body:
+                for product, values in records.items():
+                    detail_body.add(*cls._draw_product(product, values,
+                            totals[product], parameters, prefix=prefix,
+                            rendered=rendered))
+        return detail_table
+
+    @classmethod
+    def _draw_detail_lite(cls, records, totals, parameters, prefix='product',
+            rendered=None):
+        "Return the totals of each product with its lot details of the lite HTML"
+        if rendered is None:
+            rendered = set()
+        detail = div(cls='detail')
+        with detail:
+            div(span('Product'), span('Quantity'), span('Consumption'),
+                cls='head')
+            with div(cls='products') as products:
+                for product, values in records.items():
+                    products.add(*cls._draw_product(product, values,
+                            totals[product], parameters, prefix=prefix,
+                            rendered=rendered))
+        return detail
+
+    @classmethod
+    def _draw_product(cls, product, values, product_totals, parameters,
+            prefix='product', rendered=None):
+        "Return the rows of the product totals and of its lot details"
+        if HTML == 'lite':
+            return cls._draw_product_lite(product, values, product_totals,
+                parameters, rendered=rendered)
+        render = cls.render
+        prefetched = parameters['prefetched']
+        uoms = prefetched['product.uom']
+        key = '%s-%s' % (prefix, product)
+        totals_row = tr()
+        with totals_row:
+            with td(width='50%'):
+                with a(href='#%s' % key,
+                    cls='',
+                    **{
+                        'data-toggle': 'collapse',
+                        'role': 'button',
+                        'aria-expanded': 'false',
+                        'aria-controls': key,
+                    }):
+                    i(cls='fas fa-angle-double-right')
+                    raw(' %s' % prefetched['product.product'][product][
+                            'rec_name'])
+            td('%s %s' % (
+                render(product_totals['quantity'], digits=4),
+                uoms[product_totals['quantity_uom']]['symbol']),
+                width='10%')
+            td('%s %s' % (
+                render(product_totals['consumption'], digits=4),
+                uoms[product_totals['consumption_uom']]['symbol']),
+                width='10%')
+        details_row = tr()
+        with details_row:
+            with td(colspan='3') as detail_cell:
+                if parameters.get('details_url'):
+                    div(cls='collapse multi-collapse', id=key, **{
+                            'data-url': '%s&%s' % (
+                                parameters['details_url'],
+                                urlencode({'product': product})),
+                            })
+                else:
+                    detail_cell.add(cls._draw_table(
+                        key,
+                        values,
+                        parameters,
+                        product=product,
+                        rendered=rendered))
+        return totals_row, details_row
+
+    @classmethod
+    def _draw_product_lite(cls, product, values, product_totals, parameters,
+            rendered=None):
+        "Return the product totals with its lot details of the lite HTML"
+        render = cls.render
+        prefetched = parameters['prefetched']
+        uoms = prefetched['product.uom']
+        item = details_tag()
+        with item:
+            summary(
+                span(prefetched['product.product'][product]['rec_name']),
+                span('%s %s' % (
+                        render(product_totals['quantity'], digits=4),
+                        uoms[product_totals['quantity_uom']]['symbol'])),
+                span('%s %s' % (
+                        render(product_totals['consumption'], digits=4),
+                        uoms[product_totals['consumption_uom']]['symbol'])))
+            if parameters.get('details_url'):
+                item['data-url'] = '%s&%s' % (
+                    parameters['details_url'], urlencode({'product': product}))
+            else:
+                cls._draw_table(None, values, parameters, product=product,
+                    rendered=rendered)
+        return item,
+
+    @classmethod
+    def _yield_variance(cls, values):
+        "Return the relative difference of the consumption with the BOM"
+        if values['expected']:
+            return values['expected_consumed'] / values['expected'] - 1
+
+    @classmethod
+    def _draw_yield(cls, yields, parameters):
+        "Return the table of the yield values by product"
+        render = cls.render
+        prefetched = parameters['prefetched']
+        uoms = prefetched['product.uom']
+        yield_table = table(cls='table table-sm')
+        with yield_table:
+            with thead():
+                with tr():
+                    for name in ['Product', 'Productions', 'Produced',
+                            'Consumed', 'Per Unit', 'Min', 'Max', 'Expected',
+                            'Variance', 'Outliers']:
+                        th(name, scope='col')
+            with tbody():
+                for values in yields:
+                    consumed_uom = uoms[values['consumed_uom']]['symbol']
+                    produced = values['produced']
+                    variance = cls._yield_variance(values)
+                    with tr():
+                        td(prefetched['product.product'][values['product']][
+                                'rec_name'])
+                        td(str(values['productions']))
+                        td('%s %s' % (render(produced, digits=4),
+                                uoms[values['produced_uom']]['symbol']))
+                        td('%s %s' % (render(values['consumed'], digits=4),
+                                consumed_uom))
+                        td(render(values['consumed'] / produced, digits=4)
+                            if produced else '')
+                        td(render(values['minimum'], digits=4)
+                            if values['minimum'] is not None else '')
+                        td(render(values['maximum'], digits=4)
+                            if values['maximum'] is not None else '')
+                        td('%s %s' % (render(values['expected'], digits=4),
+                                consumed_uom)
+                            if values['expected'] is not None else '')
+                        td('%s %%' % render(variance * 100, digits=2)
+                            if variance is not None else '')
+                        td(str(values['outliers']))
+        return yield_table
+
     @classmethod
     def css(cls, action, data, records):
+        if HTML == 'lite':
+            return LITE_CSS
         return "\n".join([
             "@import url('https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/css/bootstrap.min.css');",
             "@import url('https://use.fontawesome.com/releases/v5.7.0/css/all.css');",
@@ -298,8 +2012,78 @@ class PrintProductionTraceabilityReport(DominateReport):
     def title(cls, action, data, records):
         return 'Traceability'
 
+    @classmethod
+    def _is_streamed(cls, parameters):
+        return RENDER == 'stream' and parameters.get('mode') != 'yield'
+
     @classmethod
     def body(cls, action, data, records):
+        if cls._is_streamed(data['parameters']):
+            # Only the place of the body, it is written by _execute once the
+            # document is rendered
+            return comment('production_traceability_report body')
+        with TraceabilityStats.stage('render'):
+            return cls._draw_body(action, data, records)
+
+    @classmethod
+    def body_chunks(cls, action, data, records, indent='  ', level=0):
+        """
+        Yield the rendering of the body one product section at a time so only
+        the elements of one product are kept in memory.
+        The joined chunks are the same as the rendering of body() at the
+        indentation level.
+        It must not be called in the context of a document as the elements
+        would be added to it.
+        """
+        parameters = data['parameters']
+        sections = data['sections']
+        skeleton = ''.join(cls._draw_body(action,
+                dict(data, sections=[dict(s, records=OrderedDict(), totals={})
+                        for s in sections]),
+                records)._render([], level, indent, True, False))
+        # The details bodies are the only empty ones of the skeleton
+        start, end = cls._details_body()
+        parts = skeleton.split(start + end)
+        assert len(parts) == len(sections) + 1
+
+        rendered = set()
+        for index, (section, head) in enumerate(zip(sections, parts)):
+            level = (len(head) - head.rfind('\n') - 1) // len(indent) + 1
+            yield head + start
+            section_parameters = cls._section_parameters(section, parameters)
+            for product, values in section['records'].items():
+                rows = cls._draw_product(product, values,
+                    section['totals'][product], section_parameters,
+                    prefix=cls._section_prefix(index), rendered=rendered)
+                chunk = []
+                for row in rows:
+                    chunk += ['\n', indent * level]
+                    row._render(chunk, level, indent, True, False)
+                yield ''.join(chunk)
+            if section['records']:
+                yield '\n' + indent * (level - 1)
+            yield end
+        yield parts[-1]
+
+    @classmethod
+    def _details_body(cls):
+        "Return the tags of the element containing the products of a detail"
+        if HTML == 'lite':
+            return '<div class="products">', '</div>'
+        return '<tbody>', '</tbody>'
+
+    @classmethod
+    def _section_prefix(cls, index):
+        return 'product' if not index else 'product%s' % index
+
+    @classmethod
+    def _section_parameters(cls, section, parameters):
+        if section.get('details_url'):
+            return dict(parameters, details_url=section['details_url'])
+        return parameters
+
+    @classmethod
+    def _draw_body(cls, action, data, records):
         parameters = data['parameters']
         render = cls.render
         wrapper = div()
@@ -324,23 +2108,21 @@ class PrintProductionTraceabilityReport(DominateReport):
                             raw(' %s' % (
                                 'Backward' if parameters['direction'] == 'backward'
                                 else 'Forward'))
-                    with tr():
-                        with td():
-                            strong('Product:')
-                            raw(' %s' % parameters['requested_product'].rec_name)
-                        with td():
-                            if parameters.get('lot'):
-                                strong('Lot:')
-                                raw(' %s' % parameters['lot'].number)
-                        with td():
-                            if parameters.get('lot'):
-                                strong('Expiration Date:')
-                                raw(' %s' % parameters['lot'].expiration_date)
-                    with tr():
-                        with td(colspan='3'):
-                            strong('Quantity:')
-                            raw(' quantity produced including all outgoing moves in production')
-                            raw('<br>')
+                    if parameters.get('mode') == 'yield':
+                        with tr():
+                            with td(colspan='3'):
+                                strong('Yield:')
+                                raw(' consumption per unit produced of the '
+                                    'productions, expected by their BOM and '
+                                    'number of productions that differ by '
+                                    'more than %s %% from it' % render(
+                                        YIELD_TOLERANCE * 100, digits=0))
+                    else:
+                        with tr():
+                            with td(colspan='3'):
+                                strong('Quantity:')
+                                raw(' quantity produced including all outgoing moves in production')
+                                raw('<br>')
                     if parameters.get('show_date'):
                         with tr():
                             with td():
@@ -349,71 +2131,179 @@ class PrintProductionTraceabilityReport(DominateReport):
                             with td():
                                 strong('To Date:')
                                 raw(' %s' % render(parameters['to_date']))
-                    with tr():
-                        with td(colspan='3'):
-                            with table(cls='table', id='detail'):
-                                with thead():
-                                    with tr():
-                                        th('Product', scope='col', width='50%')
-                                        th('Quantity', scope='col', width='10%')
-                                        th('Consumption', scope='col', width='10%')
-                                with tbody():
-                                    for product, values in data['records'].items():
-                                        key = 'product-%s' % product.id
-                                        totals = data['totals'][product]
-                                        with tr():
-                                            with td(width='50%'):
-                                                with a(href='#%s' % key,
-                                                    cls='',
-                                                    **{
-                                                        'data-toggle': 'collapse',
-                                                        'role': 'button',
-                                                        'aria-expanded': 'false',
-                                                        'aria-controls': key,
-                                                    }):
-                                                    i(cls='fas fa-angle-double-right')
-                                                    raw(' %s' % product.rec_name)
-                                            td('%s %s' % (
-                                                render(totals['quantity'], digits=4),
-                                                totals['quantity_uom'].symbol),
-                                                width='10%')
-                                            td('%s %s' % (
-                                                render(totals['consumption'], digits=4),
-                                                totals['consumption_uom'].symbol),
-                                                width='10%')
-                                        with tr():
-                                            with td(colspan='3') as detail_cell:
-                                                detail_cell.add(cls._draw_table(
-                                                    key,
-                                                    values,
-                                                    parameters))
-            script(src='https://code.jquery.com/jquery-3.3.1.slim.min.js',
-                integrity='sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo',
-                crossorigin='anonymous')
-            script(src='https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/popper.min.js',
-                integrity='sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9WO1clHTMGa3JDZwrnQq4sF86dIHNDz0W1',
-                crossorigin='anonymous')
-            script(src='https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js',
-                integrity='sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM',
-                crossorigin='anonymous')
-            script(raw("""
+                    rendered = set()
+                    for index, section in enumerate(data['sections']):
+                        with tr():
+                            with td():
+                                strong('Product:')
+                                raw(' %s' % section['product'].rec_name)
+                            with td():
+                                if section['lot']:
+                                    strong('Lot:')
+                                    raw(' %s' % section['lot'].number)
+                            with td():
+                                if section['lot']:
+                                    strong('Expiration Date:')
+                                    raw(' %s' % section['lot'].expiration_date)
+                        if parameters.get('mode') == 'yield':
+                            with tr():
+                                with td(colspan='3') as yield_cell:
+                                    yield_cell.add(cls._draw_yield(
+                                            section['yields'], parameters))
+                            continue
+                        with tr():
+                            with td(colspan='3') as detail_cell:
+                                detail_cell.add(cls._draw_detail(
+                                    section['records'],
+                                    section['totals'],
+                                    cls._section_parameters(section,
+                                        parameters),
+                                    prefix=cls._section_prefix(index),
+                                    rendered=rendered))
+            if HTML == 'lite':
+                cls._draw_scripts_lite(data['sections'])
+            else:
+                cls._draw_scripts(data['sections'])
+        return wrapper
+
+    @classmethod
+    def _draw_scripts(cls, sections):
+        script(src='https://code.jquery.com/jquery-3.3.1.slim.min.js',
+            integrity='sha384-q8i/X+965DzO0rT7abK41JStQIAqVgRVzpbzo5smXKp4YfRvH+8abtTE1Pi6jizo',
+            crossorigin='anonymous')
+        script(src='https://cdnjs.cloudflare.com/ajax/libs/popper.js/1.14.7/umd/popper.min.js',
+            integrity='sha384-UO2eT0CpHqdSJQ6hJty5KVphtPhzWj9WO1clHTMGa3JDZwrnQq4sF86dIHNDz0W1',
+            crossorigin='anonymous')
+        script(src='https://stackpath.bootstrapcdn.com/bootstrap/4.3.1/js/bootstrap.min.js',
+            integrity='sha384-JjSmVgyd0p3pXB1rRibZUAYoIIy6OrQ6VrjIEaFf/nJGzIxFDsf4x0xIM+B07jRM',
+            crossorigin='anonymous')
+        script(raw("""
 function expand() {
   $('.collapse').collapse('show');
 }
 """), type='text/javascript', charset='utf-8')
-        return wrapper
+        if any(s.get('details_url') for s in sections):
+            script(raw("""
+function load_details(section, url) {
+  fetch(url).then(function (response) {
+    return response.text();
+  }).then(function (html) {
+    section.find('.next-page').remove();
+    section.append(html);
+  });
+}
+$(document).on('show.bs.collapse', '[data-url]', function () {
+  var section = $(this);
+  if (!section.data('loaded')) {
+    section.data('loaded', true);
+    load_details(section, section.data('url'));
+  }
+});
+$(document).on('click', '.next-page', function (event) {
+  event.preventDefault();
+  var section = $(this).closest('[data-url]');
+  load_details(section, section.data('url').split('?')[0]
+    + $(this).attr('href'));
+});
+"""), type='text/javascript', charset='utf-8')
+
+    @classmethod
+    def _draw_scripts_lite(cls, sections):
+        script(raw("""
+function expand() {
+  document.querySelectorAll('details').forEach(function (section) {
+    section.open = true;
+  });
+}
+"""))
+        if any(s.get('details_url') for s in sections):
+            script(raw("""
+function load_details(section, url) {
+  fetch(url).then(function (response) {
+    return response.text();
+  }).then(function (html) {
+    var next = section.querySelector('.next-page');
+    if (next) {
+      next.remove();
+    }
+    section.insertAdjacentHTML('beforeend', html);
+  });
+}
+document.addEventListener('toggle', function (event) {
+  var section = event.target;
+  if (section.open && section.dataset.url && !section.dataset.loaded) {
+    section.dataset.loaded = 'true';
+    load_details(section, section.dataset.url);
+  }
+}, true);
+document.addEventListener('click', function (event) {
+  var next = event.target.closest('.next-page');
+  if (next) {
+    event.preventDefault();
+    var section = next.closest('[data-url]');
+    load_details(section, section.dataset.url.split('?')[0]
+      + next.getAttribute('href'));
+  }
+});
+"""))
 
     @classmethod
     def execute(cls, ids, data):
-        records, totals, parameters = cls.prepare(data)
-        return super().execute(ids, {
+        if data.get('model') == 'production.traceability.snapshot':
+            # Printed from the snapshot
+            Snapshot = Pool().get('production.traceability.snapshot')
+            data = Snapshot(data.get('id') or ids[0]).get_report_data()
+        with TraceabilityStats.record(cls.__name__,
+                engine=ENGINE,
+                direction=data['direction'],
+                depth=data.get('depth') or 1,
+                output_format=data.get('output_format', 'html'),
+                roots=len(cls.get_roots(data))):
+            return cls._execute(ids, data)
+
+    @classmethod
+    def _execute(cls, ids, data):
+        if data.get('output_format', 'html') != 'html':
+            ActionReport = Pool().get('ir.action.report')
+            action_report, = ActionReport.search([
+                    ('report_name', '=', cls.__name__),
+                    ], limit=1)
+            with TraceabilityStats.stage('export'):
+                content = ''.join(cls.export(data))
+            return (data['output_format'], content,
+                action_report.direct_print, action_report.name)
+        with TraceabilityStats.stage('prepare'):
+            sections, parameters = cls.prepare(data)
+        with TraceabilityStats.stage('prefetch'):
+            cls.prefetch(sections, parameters)
+        report_data = {
             'name': 'production.traceability.report',
             'model': data['model'],
-            'records': records,
-            'totals': totals,
+            'sections': sections,
             'parameters': parameters,
             'output_format': 'html',
             'report_options': {
                 'now': datetime.now(),
                 }
-            })
+            }
+        with TraceabilityStats.stage('serialize'):
+            result = super().execute(ids, report_data)
+        if not cls._is_streamed(parameters):
+            return result
+        with TraceabilityStats.stage('render'):
+            ext, content, direct_print, name = result
+            return (ext, cls._write_body(content, report_data), direct_print,
+                name)
+
+    @classmethod
+    def _write_body(cls, content, data, indent='  '):
+        "Write the body chunks in place of the marker of the document"
+        before, after = content.split(_BODY_MARKER)
+        level = (len(before) - before.rfind('\n') - 1) // len(indent)
+        buffer = io.StringIO()
+        buffer.write(before)
+        for chunk in cls.body_chunks(None, data, None, indent=indent,
+                level=level):
+            buffer.write(chunk)
+        buffer.write(after)
+        return buffer.getvalue()
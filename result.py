@@ -0,0 +1,124 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import json
+import logging
+import threading
+
+from trytond.bus import notify
+from trytond.config import config
+from trytond.i18n import gettext
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.transaction import Transaction, without_check_access
+
+logger = logging.getLogger(__name__)
+
+
+class TraceabilityResult(ModelSQL, ModelView):
+    'Production Traceability Result'
+    __name__ = 'production.traceability.result'
+    name = fields.Char('Name', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    state = fields.Selection([
+            ('queued', 'Queued'),
+            ('done', 'Done'),
+            ('error', 'Error'),
+            ], 'State', readonly=True)
+    data = fields.Text('Data', readonly=True)
+    report = fields.Binary('Report', filename='report_name', readonly=True)
+    report_name = fields.Char('Report Name', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TraceabilityResult, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @staticmethod
+    def default_state():
+        return 'queued'
+
+    @classmethod
+    def enqueue(cls, data):
+        "Create a result for the report data and generate it in background"
+        Report = Pool().get('production.traceability.report', type='report')
+        transaction = Transaction()
+        context = transaction.context
+
+        name = Report.get_name(data)
+
+        data = data.copy()
+        request = context.get('_request') or {}
+        data['_request'] = {
+            'scheme': request.get('scheme'),
+            'http_host': request.get('http_host'),
+            }
+        result, = cls.create([{
+                    'name': name,
+                    'company': context.get('company'),
+                    'data': json.dumps(data, cls=JSONEncoder,
+                        separators=(',', ':')),
+                    }])
+        if config.getboolean('queue', 'worker', default=False):
+            cls.__queue__.generate([result])
+        else:
+            transaction.atexit(cls._generate_thread,
+                transaction.database.name, transaction.user, result.id)
+        notify(gettext('production_traceability_report.msg_report_queued',
+                name=result.name))
+        return result
+
+    @classmethod
+    def _generate_thread(cls, database_name, user, result_id):
+        "Generate the result in a thread when there is no queue worker"
+        thread = threading.Thread(target=cls._generate_local,
+            args=(database_name, user, result_id), daemon=True)
+        thread.start()
+
+    @staticmethod
+    def _generate_local(database_name, user, result_id):
+        with Transaction().start(database_name, user):
+            pool = Pool()
+            Result = pool.get('production.traceability.result')
+            Result.generate(Result.search([('id', '=', result_id)]))
+
+    @classmethod
+    def generate(cls, results):
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+        for result in results:
+            if result.state != 'queued':
+                continue
+            data = json.loads(result.data, object_hook=JSONDecoder())
+            context = {
+                '_request': data.pop('_request', None),
+                }
+            if result.company:
+                context['company'] = result.company.id
+            try:
+                with Transaction().set_context(**context):
+                    ext, content, _, name = Report.execute([], data)
+            except Exception:
+                logger.error('Could not generate the traceability result %s',
+                    result.id, exc_info=True)
+                cls._set_error(result.id)
+                continue
+            if isinstance(content, str):
+                content = content.encode('utf-8')
+            result.report = content
+            result.report_name = '%s.%s' % (name, ext)
+            result.state = 'done'
+            result.save()
+            notify(gettext('production_traceability_report.msg_report_done',
+                    name=result.name),
+                user=result.create_uid.id)
+
+    @classmethod
+    def _set_error(cls, result_id):
+        "Set the result in error in a new transaction and notify its user"
+        with Transaction().new_transaction(), without_check_access():
+            result = cls(result_id)
+            cls.write([result], {'state': 'error'})
+            notify(gettext('production_traceability_report.msg_report_error',
+                    name=result.name),
+                user=result.create_uid.id)
@@ -0,0 +1,103 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import itertools
+from datetime import date
+
+from trytond.protocols.wrappers import (
+    Response, abort, allow_null_origin, with_pool, with_transaction)
+from trytond.transaction import Transaction
+from trytond.wsgi import app
+
+from .stats import TraceabilityStats
+
+CONTENT_TYPES = {
+    'csv': 'text/csv',
+    'jsonl': 'application/jsonl',
+    'dot': 'text/vnd.graphviz',
+    'json': 'application/json',
+    }
+
+
+@app.route('/<database_name>/production_traceability/details',
+    methods=['GET'])
+@allow_null_origin
+@with_pool
+@with_transaction(readonly=True)
+def details(request, pool):
+    Report = pool.get('production.traceability.report', type='report')
+    token = request.args.get('token', '')
+    try:
+        data = Report.details_data(token)
+    except ValueError:
+        abort(403)
+    if data['database'] != pool.database_name:
+        abort(403)
+
+    transaction = Transaction()
+    with transaction.set_user(data['user']), \
+            transaction.set_context(company=data['company']), \
+            TraceabilityStats.record(Report.__name__ + '.details',
+                direction=data['direction']):
+        content = Report.details(token,
+            request.args.get('product', type=int),
+            offset=request.args.get('offset', 0, type=int))
+    return Response(content, 200, content_type='text/html')
+
+
+@app.route('/<database_name>/production_traceability/export',
+    methods=['GET'])
+@app.auth_required
+@with_pool
+def export(request, pool):
+    "Stream the csv, jsonl, dot or json export of the traceability"
+    args = request.args
+    try:
+        data = {
+            'output_format': args.get('format', 'csv'),
+            'mode': 'traceability',
+            'direction': args.get('direction', 'backward'),
+            'depth': args.get('depth', 1, type=int),
+            'product': args.get('product', type=int),
+            'lot': args.get('lot', type=int),
+            'products': args.getlist('products', type=int),
+            'lots': args.getlist('lots', type=int),
+            'from_date': _get_date(args.get('from_date')),
+            'to_date': _get_date(args.get('to_date')),
+            }
+    except ValueError:
+        abort(400)
+    if (data['output_format'] not in CONTENT_TYPES
+            or data['direction'] not in {'backward', 'forward'}
+            or not (data['product'] or data['products'] or data['lots'])):
+        abort(400)
+
+    lines = _export_lines(pool, request.user_id, request.context, data)
+    # The first lines are read before answering so the access and data
+    # errors are raised before the response is started
+    first = next(lines, '')
+    return Response(itertools.chain([first], lines), 200,
+        content_type=CONTENT_TYPES[data['output_format']])
+
+
+def _get_date(value):
+    return date.fromisoformat(value) if value else None
+
+
+def _export_lines(pool, user_id, request_context, data):
+    "Yield the lines of the export in a transaction of the user"
+    Report = pool.get('production.traceability.report', type='report')
+    ActionReport = pool.get('ir.action.report')
+    User = pool.get('res.user')
+    with Transaction().start(pool.database_name, user_id, readonly=True,
+            context={'_request': request_context}) as transaction:
+        with transaction.set_context(
+                User.get_preferences(context_only=True)):
+            action_report, = ActionReport.search([
+                    ('report_name', '=', Report.__name__),
+                    ], limit=1)
+            Report.check_access(action_report, None, [])
+            with TraceabilityStats.record(Report.__name__ + '.export',
+                    direction=data['direction'],
+                    depth=data['depth'],
+                    output_format=data['output_format']):
+                yield from Report.export(data)
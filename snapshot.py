@@ -0,0 +1,341 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import datetime as dt
+import json
+
+from sql import Cast, Literal, Null
+from sql.aggregate import Max
+from sql.functions import CurrentTimestamp
+
+from trytond.config import config
+from trytond.model import fields, Index, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.protocols.jsonrpc import JSONDecoder, JSONEncoder
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+
+# number of seconds before the last write of a snapshot from which the moves
+# are checked again on refresh, for the transactions not yet committed then
+MARGIN = config.getint('production_traceability_report', 'snapshot_margin',
+    default=60 * 60)
+
+
+class TraceabilitySnapshot(ModelSQL, ModelView):
+    'Production Traceability Snapshot'
+    __name__ = 'production.traceability.snapshot'
+    name = fields.Char('Name', required=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    data = fields.Text('Data', readonly=True)
+    last_move = fields.Integer('Last Move', readonly=True,
+        help='The highest id of the moves when the rows were computed.')
+    last_write = fields.Timestamp('Last Write', readonly=True,
+        help='The latest modification of the production moves when the rows '
+        'were computed.')
+    lines = fields.One2Many('production.traceability.snapshot.line',
+        'snapshot', 'Lines', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TraceabilitySnapshot, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+        cls._buttons.update({
+                'refresh': {},
+                'print_': {},
+                })
+
+    @classmethod
+    def create_from_data(cls, data):
+        "Create and compute a snapshot of the report data"
+        Report = Pool().get('production.traceability.report', type='report')
+        data = data.copy()
+        data['mode'] = 'traceability'
+        data.pop('snapshot', None)
+        snapshot, = cls.create([{
+                    'name': Report.get_name(data),
+                    'company': Transaction().context.get('company'),
+                    'data': json.dumps(data, cls=JSONEncoder,
+                        separators=(',', ':')),
+                    }])
+        cls.refresh([snapshot])
+        return snapshot
+
+    def get_report_data(self):
+        "Return the report data reading the rows of the snapshot"
+        data = json.loads(self.data, object_hook=JSONDecoder())
+        data['snapshot'] = self.id
+        return data
+
+    @classmethod
+    @ModelView.button
+    def refresh(cls, snapshots):
+        """
+        Merge into the snapshots the rows of the productions with moves
+        created or modified since their last computation
+        """
+        Report = Pool().get('production.traceability.report', type='report')
+        for snapshot in snapshots:
+            last_move, last_write = cls._get_watermark()
+            snapshot._refresh()
+            snapshot.last_move = last_move
+            snapshot.last_write = last_write
+        cls.save(snapshots)
+        Report.clear_cache()
+
+    @classmethod
+    @ModelView.button_action(
+        'production_traceability_report.report_production_traceability')
+    def print_(cls, snapshots):
+        pass
+
+    @classmethod
+    def _get_watermark(cls):
+        '''
+        Return the highest move id and the latest creation or write date of
+        the production moves and the write date of the productions
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+        production = Production.__table__()
+
+        cursor.execute(*move.select(Max(move.id)))
+        last_move, = cursor.fetchone()
+        queries = []
+        for side in ['production_input', 'production_output']:
+            for date in [move.create_date, move.write_date]:
+                queries.append(move.select(date,
+                        where=(getattr(move, side) != Null) & (date != Null),
+                        order_by=[date.desc],
+                        limit=1))
+        queries.append(production.select(production.write_date,
+                where=production.write_date != Null,
+                order_by=[production.write_date.desc],
+                limit=1))
+        last_write = None
+        for query in queries:
+            # Ordered instead of aggregated to keep the column type on SQLite
+            cursor.execute(*query)
+            row = cursor.fetchone()
+            if row and (not last_write or row[0] > last_write):
+                last_write, = row
+        return last_move, last_write
+
+    def _get_changed_productions(self):
+        '''
+        Return the ids of the productions with moves changed since the rows.
+        The moves created or written in the margin before the last write are
+        checked again as their transactions may have been committed after the
+        rows were computed, and so are the changed productions.
+        '''
+        pool = Pool()
+        Move = pool.get('stock.move')
+        Production = pool.get('production')
+        cursor = Transaction().connection.cursor()
+        move = Move.__table__()
+        production = Production.__table__()
+
+        productions = set()
+        for side in ['production_input', 'production_output']:
+            column = getattr(move, side)
+            changed = move.id > (self.last_move or 0)
+            if self.last_write:
+                since = self.last_write - dt.timedelta(seconds=MARGIN)
+                changed |= ((move.create_date > since)
+                    | (move.write_date > since))
+            else:
+                changed |= move.write_date != Null
+            cursor.execute(*move.select(column,
+                    where=(column != Null) & changed,
+                    distinct=True))
+            productions.update(p for p, in cursor)
+
+        # The productions are touched when their moves are deleted
+        if self.last_write:
+            changed = production.write_date > since
+        else:
+            changed = production.write_date != Null
+        cursor.execute(*production.select(production.id, where=changed))
+        productions.update(p for p, in cursor)
+        return sorted(productions)
+
+    def _refresh(self):
+        """
+        Compute the rows of the keys reached for the first time and replace
+        the rows of the changed productions of the other keys, level by level
+        """
+        pool = Pool()
+        Line = pool.get('production.traceability.snapshot.line')
+        Report = pool.get('production.traceability.report', type='report')
+
+        data = self.get_report_data()
+        direction = data['direction']
+        depth = data.get('depth') or 1
+        from_date, to_date = data.get('from_date'), data.get('to_date')
+        company_id = self.company.id if self.company else None
+        if self.last_move is None:
+            productions = None
+        else:
+            productions = self._get_changed_productions()
+
+        keys = Report.get_roots(data)
+        visited = set(keys)
+        for level in range(depth):
+            if level:
+                from_date = to_date = None
+            stored = Line.get_keys(self, level)
+            removed = stored - set(keys)
+            if removed:
+                Line.delete_rows(self, level, keys=removed)
+            if productions:
+                Line.delete_rows(self, level, productions=productions)
+
+            new = [k for k in keys if k not in stored]
+            if new:
+                Line.insert_rows(self, level, Report._get_rows(direction,
+                        new, from_date, to_date, company_id))
+            old = [k for k in keys if k in stored]
+            if old and productions:
+                Line.insert_rows(self, level, Report._get_rows(direction,
+                        old, from_date, to_date, company_id,
+                        productions=productions))
+
+            keys = [k for k in Line.get_children(self, level)
+                if k not in visited]
+            visited.update(keys)
+            if not keys:
+                break
+        Line.delete_rows(self, level + 1, deeper=True)
+
+    def iter_rows(self):
+        "Yield the traceability rows of the snapshot level by level"
+        Line = Pool().get('production.traceability.snapshot.line')
+        cursor = Transaction().connection.cursor()
+        line = Line.__table__()
+        has_lot = hasattr(Line, 'lot')
+        order_by = [line.level, line.production, line.product]
+        if has_lot:
+            order_by.append(line.lot)
+        cursor.execute(*line.select(
+                line.key_product,
+                line.key_lot if has_lot else Cast(Null, 'INTEGER'),
+                line.production, line.product,
+                line.lot if has_lot else Cast(Null, 'INTEGER'),
+                line.quantity, line.requested_quantity,
+                where=line.snapshot == self.id,
+                order_by=order_by))
+        yield from cursor
+
+
+class TraceabilitySnapshotLine(ModelSQL):
+    'Production Traceability Snapshot Line'
+    __name__ = 'production.traceability.snapshot.line'
+    snapshot = fields.Many2One('production.traceability.snapshot', 'Snapshot',
+        required=True, ondelete='CASCADE', readonly=True)
+    level = fields.Integer('Level', required=True, readonly=True)
+    key_product = fields.Many2One('product.product', 'Requested Product',
+        required=True, readonly=True)
+    production = fields.Many2One('production', 'Production', required=True,
+        ondelete='CASCADE', readonly=True)
+    product = fields.Many2One('product.product', 'Product', required=True,
+        readonly=True)
+    quantity = fields.Float('Quantity', readonly=True)
+    requested_quantity = fields.Float('Requested Quantity', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TraceabilitySnapshotLine, cls).__setup__()
+        try:
+            Lot = Pool().get('stock.lot')
+        except:
+            Lot = None
+        if Lot:
+            cls.key_lot = fields.Many2One('stock.lot', 'Requested Lot',
+                readonly=True)
+            cls.lot = fields.Many2One('stock.lot', 'Lot', readonly=True)
+
+        t = cls.__table__()
+        cls._sql_indexes.update({
+                Index(t,
+                    (t.snapshot, Index.Range()),
+                    (t.level, Index.Range()),
+                    (t.production, Index.Range())),
+                Index(t, (t.production, Index.Range())),
+                })
+
+    @classmethod
+    def get_keys(cls, snapshot, level):
+        "Return the (product id, lot id) keys of the rows of the level"
+        cursor = Transaction().connection.cursor()
+        line = cls.__table__()
+        key_lot = (line.key_lot if hasattr(cls, 'key_lot')
+            else Cast(Null, 'INTEGER'))
+        cursor.execute(*line.select(line.key_product, key_lot,
+                where=(line.snapshot == snapshot.id) & (line.level == level),
+                distinct=True))
+        return set(cursor)
+
+    @classmethod
+    def get_children(cls, snapshot, level):
+        "Return the (product id, lot id) lots reached by the rows of the level"
+        if not hasattr(cls, 'lot'):
+            return []
+        cursor = Transaction().connection.cursor()
+        line = cls.__table__()
+        cursor.execute(*line.select(line.product, line.lot,
+                where=(line.snapshot == snapshot.id) & (line.level == level)
+                & (line.lot != Null),
+                distinct=True))
+        return list(cursor)
+
+    @classmethod
+    def delete_rows(cls, snapshot, level, keys=None, productions=None,
+            deeper=False):
+        "Delete the rows of the level of the keys or the production ids"
+        cursor = Transaction().connection.cursor()
+        line = cls.__table__()
+        where = line.snapshot == snapshot.id
+        if deeper:
+            where &= line.level >= level
+        else:
+            where &= line.level == level
+        if productions is not None:
+            for sub_ids in grouped_slice(productions):
+                cursor.execute(*line.delete(
+                        where=where & reduce_ids(line.production, sub_ids)))
+        elif keys is not None:
+            for product, lot in keys:
+                key_where = where & (line.key_product == product)
+                if hasattr(cls, 'key_lot'):
+                    key_where &= (line.key_lot == lot) if lot else (
+                        line.key_lot == Null)
+                cursor.execute(*line.delete(where=key_where))
+        else:
+            cursor.execute(*line.delete(where=where))
+
+    @classmethod
+    def insert_rows(cls, snapshot, level, rows):
+        "Insert the traceability rows in the level of the snapshot"
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        line = cls.__table__()
+        has_lot = hasattr(cls, 'lot')
+
+        columns = [line.create_uid, line.create_date, line.snapshot,
+            line.level, line.key_product, line.production, line.product,
+            line.quantity, line.requested_quantity]
+        if has_lot:
+            columns += [line.key_lot, line.lot]
+        for sub_rows in grouped_slice(rows):
+            values = []
+            for (key_product, key_lot, production, product, lot, quantity,
+                    requested_quantity) in sub_rows:
+                value = [Literal(transaction.user), CurrentTimestamp(),
+                    snapshot.id, level, key_product, production, product,
+                    quantity, requested_quantity]
+                if has_lot:
+                    value += [key_lot, lot]
+                values.append(value)
+            if values:
+                cursor.execute(*line.insert(columns, values=values))
@@ -0,0 +1,234 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from trytond.config import config
+from trytond.model import fields, ModelSQL, ModelView
+from trytond.pool import Pool
+from trytond.transaction import Transaction, without_check_access
+
+logger = logging.getLogger(__name__)
+
+# level at which the statistics of each report execution are logged
+LOG_LEVEL = getattr(logging, config.get('production_traceability_report',
+        'stats_log_level', default='debug').upper())
+# store the statistics of each report execution
+STORE = config.getboolean('production_traceability_report', 'store_stats',
+    default=False)
+
+_local = threading.local()
+
+
+@contextmanager
+def count_queries(connection, callback):
+    "Call callback for each query executed on the connection"
+    counters = getattr(_local, 'counters', None)
+    if counters is not None:
+        # The counter of the connection is already installed
+        counters.append(callback)
+        try:
+            yield
+        finally:
+            counters.remove(callback)
+        return
+
+    counters = _local.counters = [callback]
+
+    def count(*args):
+        for counter in counters:
+            counter()
+
+    if hasattr(connection, 'set_trace_callback'):
+        # SQLite
+        connection.set_trace_callback(count)
+        try:
+            yield
+        finally:
+            connection.set_trace_callback(None)
+            del _local.counters
+        return
+
+    factory = getattr(connection, 'cursor_factory', False)
+    if factory is False:
+        del _local.counters
+        yield
+        return
+    if factory is None:
+        from psycopg2.extensions import cursor as factory
+
+    class CountingCursor(factory):
+        def execute(self, *args, **kwargs):
+            count()
+            return super().execute(*args, **kwargs)
+
+    connection.cursor_factory = CountingCursor
+    try:
+        yield
+    finally:
+        connection.cursor_factory = factory
+        del _local.counters
+
+
+class TraceabilityStats(object):
+    '''
+    Timings, queries and rows by stage of a report execution.
+    The stages can be nested, each one only counts what is not counted by its
+    nested stages.
+    '''
+
+    def __init__(self, name, parameters):
+        self.name = name
+        self.parameters = parameters
+        self.stages = OrderedDict()
+        self.duration = 0.0
+        self.queries = 0
+        self._stack = []
+
+    @classmethod
+    def current(cls):
+        return getattr(_local, 'stats', None)
+
+    @classmethod
+    @contextmanager
+    def record(cls, name, **parameters):
+        "Record the statistics of the execution and log them at the end"
+        if cls.current() is not None:
+            yield cls.current()
+            return
+        stats = _local.stats = cls(name, parameters)
+        start = time.perf_counter()
+        try:
+            with count_queries(Transaction().connection, stats._count):
+                yield stats
+        finally:
+            stats.duration = time.perf_counter() - start
+            del _local.stats
+        stats.log()
+        if STORE:
+            stats.store()
+
+    @classmethod
+    @contextmanager
+    def stage(cls, name):
+        "Record the time, queries and rows of the stage"
+        stats = cls.current()
+        if stats is None:
+            yield
+            return
+        # name, start, queries, time and queries of the nested stages
+        frame = [name, time.perf_counter(), stats.queries, 0.0, 0]
+        stats._stack.append(frame)
+        try:
+            yield
+        finally:
+            stats._stack.pop()
+            duration = time.perf_counter() - frame[1]
+            queries = stats.queries - frame[2]
+            values = stats.stages.setdefault(name, [0.0, 0, 0])
+            values[0] += duration - frame[3]
+            values[1] += queries - frame[4]
+            if stats._stack:
+                stats._stack[-1][3] += duration
+                stats._stack[-1][4] += queries
+
+    @classmethod
+    def add_rows(cls, count):
+        "Add count rows to the current stage"
+        stats = cls.current()
+        if stats is not None and stats._stack:
+            stats.stages.setdefault(stats._stack[-1][0], [0.0, 0, 0])[2] += (
+                count)
+
+    @property
+    def rows(self):
+        return sum(v[2] for v in self.stages.values())
+
+    def _count(self):
+        self.queries += 1
+
+    def store(self):
+        '''
+        Store the statistics in a transaction of their own as the reports are
+        executed in read-only transactions
+        '''
+        Stat = Pool().get('production.traceability.stat')
+        try:
+            with Transaction().new_transaction(), without_check_access():
+                Stat.store(self)
+        except Exception:
+            logger.warning('Could not store the statistics of %s',
+                self.name, exc_info=True)
+
+    def log(self):
+        if not logger.isEnabledFor(LOG_LEVEL):
+            return
+        logger.log(LOG_LEVEL, '%s %s: %.3fs, %s queries, %s rows (%s)',
+            self.name,
+            ' '.join('%s=%s' % (k, v) for k, v in self.parameters.items()),
+            self.duration, self.queries, self.rows,
+            ', '.join('%s %.3fs/%sq/%sr' % (name, *values)
+                for name, values in self.stages.items()))
+
+
+class TraceabilityStat(ModelSQL, ModelView):
+    'Production Traceability Statistic'
+    __name__ = 'production.traceability.stat'
+    name = fields.Char('Name', readonly=True)
+    company = fields.Many2One('company.company', 'Company', readonly=True)
+    engine = fields.Char('Engine', readonly=True)
+    direction = fields.Char('Direction', readonly=True)
+    depth = fields.Integer('Depth', readonly=True)
+    output_format = fields.Char('Format', readonly=True)
+    roots = fields.Integer('Roots', readonly=True,
+        help='Number of products and lots requested.')
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='In seconds.')
+    queries = fields.Integer('Queries', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
+    stages = fields.One2Many('production.traceability.stat.stage', 'stat',
+        'Stages', readonly=True)
+
+    @classmethod
+    def __setup__(cls):
+        super(TraceabilityStat, cls).__setup__()
+        cls._order.insert(0, ('create_date', 'DESC'))
+
+    @classmethod
+    def store(cls, stats):
+        "Store the statistics of a report execution"
+        parameters = stats.parameters
+        cls.create([{
+                    'name': stats.name,
+                    'company': Transaction().context.get('company'),
+                    'engine': parameters.get('engine'),
+                    'direction': parameters.get('direction'),
+                    'depth': parameters.get('depth'),
+                    'output_format': parameters.get('output_format'),
+                    'roots': parameters.get('roots'),
+                    'duration': round(stats.duration, 3),
+                    'queries': stats.queries,
+                    'rows': stats.rows,
+                    'stages': [('create', [{
+                                    'name': name,
+                                    'duration': round(duration, 3),
+                                    'queries': queries,
+                                    'rows': rows,
+                                    } for name, (duration, queries, rows)
+                                in stats.stages.items()])],
+                    }])
+
+
+class TraceabilityStatStage(ModelSQL, ModelView):
+    'Production Traceability Statistic Stage'
+    __name__ = 'production.traceability.stat.stage'
+    stat = fields.Many2One('production.traceability.stat', 'Statistic',
+        required=True, ondelete='CASCADE', readonly=True)
+    name = fields.Char('Name', readonly=True)
+    duration = fields.Float('Duration', digits=(16, 3), readonly=True,
+        help='In seconds, without the nested stages.')
+    queries = fields.Integer('Queries', readonly=True)
+    rows = fields.Integer('Rows', readonly=True)
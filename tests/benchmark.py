@@ -0,0 +1,365 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+'''
+Benchmark of the production traceability report on a synthetic factory.
+
+Run it on SQLite with:
+
+    TRYTOND_DATABASE_URI=sqlite:// DB_NAME=:memory: \
+        python -m trytond.modules.production_traceability_report.tests.benchmark
+
+It reports the wall time, the number of queries and the peak memory of each
+stage of the report for backward and forward directions, with and without
+lot and dates.
+'''
+import argparse
+import datetime as dt
+import itertools
+import json
+import random
+import statistics
+import sys
+import time
+import tracemalloc
+from decimal import Decimal
+
+from trytond import backend
+from trytond.pool import Pool
+from trytond.modules.production_traceability_report.stats import (
+    count_queries)
+from trytond.tests.test_tryton import activate_module, DB_NAME, USER
+from trytond.transaction import Transaction
+
+MODULE = 'production_traceability_report'
+START_DATE = dt.date(2024, 1, 1)
+
+
+def parse_arguments(args=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark the production traceability report")
+    parser.add_argument('--products', type=int, default=40,
+        help="number of products")
+    parser.add_argument('--levels', type=int, default=3,
+        help="number of production levels between raw materials and "
+        "finished products")
+    parser.add_argument('--productions', type=int, default=200,
+        help="number of productions")
+    parser.add_argument('--fan-in', type=int, default=4,
+        help="number of input products of each production")
+    parser.add_argument('--fan-out', type=int, default=1,
+        help="number of output products of each production")
+    parser.add_argument('--lots', type=int, default=1,
+        help="number of lots of each move, 0 for moves without lot")
+    parser.add_argument('--days', type=int, default=365,
+        help="number of days over which the productions are spread")
+    parser.add_argument('--depth', type=int, default=1,
+        help="depth of the report")
+    parser.add_argument('--engine', action='append',
+        choices=['edge', 'sql', 'python'],
+        help="engine to benchmark, can be repeated (default: configured)")
+    parser.add_argument('--repeat', type=int, default=3,
+        help="number of timed runs of each stage")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--explain', action='store_true',
+        help="print the query plans of the traceability queries")
+    parser.add_argument('--json', dest='json_file',
+        help="also write the results in this file")
+    return parser.parse_args(args)
+
+
+def create_factory(options):
+    "Create the products, lots and done productions of a synthetic factory"
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Company = pool.get('company.company')
+    Template = pool.get('product.template')
+    Location = pool.get('stock.location')
+    Lot = pool.get('stock.lot')
+    Move = pool.get('stock.move')
+    Production = pool.get('production')
+    Edge = pool.get('production.traceability.edge')
+    rng = random.Random(options.seed)
+    company_id = Transaction().context['company']
+    currency_id = Company(company_id).currency.id
+
+    unit = ModelData.get_id('product', 'uom_unit')
+    kilogram = ModelData.get_id('product', 'uom_kilogram')
+    gram = ModelData.get_id('product', 'uom_gram')
+
+    # Products by level, level 0 are the raw materials
+    levels = [[] for _ in range(options.levels + 1)]
+    templates = Template.create([{
+                'name': 'Product %s' % i,
+                'type': 'goods',
+                'producible': True,
+                'default_uom': rng.choice([unit, kilogram]),
+                'products': [('create', [{}])],
+                } for i in range(options.products)])
+    for i, template in enumerate(templates):
+        levels[i % len(levels)].append(template.products[0])
+
+    warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+    storage = warehouse.storage_location
+    production_location, = Location.search(
+        [('type', '=', 'production')], limit=1)
+
+    def unit_quantity(product):
+        quantity = rng.randint(1, 100)
+        if product.default_uom.id == kilogram and rng.random() < 0.5:
+            return gram, quantity * 1000
+        return product.default_uom.id, quantity
+
+    lots = {}
+    numbers = itertools.count(1)
+
+    def get_lot(product, new):
+        "Return a new lot or one already produced of the product"
+        if new or not lots.get(product):
+            lot, = Lot.create([{
+                        'number': 'L%s' % next(numbers),
+                        'product': product.id,
+                        }])
+            lots.setdefault(product, []).append(lot.id)
+            return lot.id
+        return rng.choice(lots[product])
+
+    def moves(products, from_location, to_location, new_lot):
+        # The moves out of the production location require a unit price
+        priced = from_location == production_location
+        values = []
+        for product in products:
+            for _ in range(max(options.lots, 1)):
+                unit_id, quantity = unit_quantity(product)
+                values.append({
+                        'product': product.id,
+                        'unit': unit_id,
+                        'quantity': quantity,
+                        'from_location': from_location.id,
+                        'to_location': to_location.id,
+                        'company': company_id,
+                        'unit_price': Decimal(0) if priced else None,
+                        'currency': currency_id if priced else None,
+                        'lot': (get_lot(product, new_lot) if options.lots
+                            else None),
+                        })
+        return values
+
+    vlist, dates = [], []
+    for i in range(options.productions):
+        level = 1 + i % options.levels
+        inputs = rng.sample(levels[level - 1],
+            min(options.fan_in, len(levels[level - 1])))
+        outputs = rng.sample(levels[level],
+            min(options.fan_out, len(levels[level])))
+        # The dates follow the creation so the lots consumed by a production
+        # were produced before it
+        dates.append(START_DATE + dt.timedelta(days=(
+                    i * options.days // options.productions)))
+        vlist.append({
+                'company': company_id,
+                'warehouse': warehouse.id,
+                'location': production_location.id,
+                'inputs': [('create', moves(inputs, storage,
+                                production_location, False))],
+                'outputs': [('create', moves(outputs, production_location,
+                                storage, True))],
+                })
+    productions = Production.create(vlist)
+
+    # Set the productions done without running the stock workflow
+    cursor = Transaction().connection.cursor()
+    production = Production.__table__()
+    move = Move.__table__()
+    for record, date in zip(productions, dates):
+        cursor.execute(*production.update(
+                [production.state, production.effective_date],
+                ['done', date],
+                where=production.id == record.id))
+        cursor.execute(*move.update(
+                [move.state, move.effective_date],
+                ['done', date],
+                where=(move.production_input == record.id)
+                | (move.production_output == record.id)))
+    Edge.rebuild()
+    return levels, lots
+
+
+def get_cases(options, levels, lots):
+    "Return the report data of each benchmarked case"
+    # A finished product and a raw material to trace from both ends
+    finished, raw = levels[-1][0], levels[0][0]
+    window = (START_DATE + dt.timedelta(days=options.days // 4),
+        START_DATE + dt.timedelta(days=options.days // 2))
+    cases = []
+    for direction, product in [('backward', finished), ('forward', raw)]:
+        lot = lots[product][0] if lots.get(product) else None
+        for lot_id in [None, lot] if lot else [None]:
+            for from_date, to_date in [(None, None), window]:
+                name = '%s%s%s' % (direction,
+                    ' lot' if lot_id else '',
+                    ' dates' if from_date else '')
+                cases.append((name, {
+                            'direction': direction,
+                            'depth': options.depth,
+                            'output_format': 'html',
+                            'from_date': from_date,
+                            'to_date': to_date,
+                            'product': product.id,
+                            'products': [],
+                            'lot': lot_id,
+                            'lots': [],
+                            'model': None,
+                            'ids': [],
+                            }))
+    return cases
+
+
+def get_stages():
+    "Return the benchmarked stages as (name, function of the report data)"
+    pool = Pool()
+    Product = pool.get('product.product')
+    Production = pool.get('production')
+    Lot = pool.get('stock.lot')
+    Report = pool.get('production.traceability.report', type='report')
+
+    def report_data(data):
+        side = 'outputs' if data['direction'] == 'backward' else 'inputs'
+        product = Product(data['product'])
+        lot = Lot(data['lot']) if data['lot'] else None
+        domain = [
+            (side + '.product', '=', product.id),
+            (side + '.state', '=', 'done'),
+            ]
+        if lot:
+            domain.append((side + '.lot', '=', lot.id))
+        if data['from_date']:
+            domain += [
+                (side + '.effective_date', '>=', data['from_date']),
+                (side + '.effective_date', '<=', data['to_date']),
+                ]
+        for production in Production.search(domain):
+            production.traceability_report_data(product, data['direction'],
+                lot)
+
+    def prepare(data):
+        Report.clear_cache()
+        return Report.prepare(data)
+
+    def body(data):
+        Report.clear_cache()
+        sections, parameters = Report.prepare(data)
+        Report.prefetch(sections, parameters)
+        return Report.body(None, {
+                'sections': sections,
+                'parameters': parameters,
+                }, None).render()
+
+    def execute(data):
+        Report.clear_cache()
+        return Report.execute([], data)
+
+    return [
+        ('report_data', report_data),
+        ('prepare', prepare),
+        ('body', body),
+        ('execute', execute),
+        ]
+
+
+def explain(data):
+    "Return the query plans of the traceability queries of the report data"
+    Report = Pool().get('production.traceability.report', type='report')
+    transaction = Transaction()
+    cursor = transaction.connection.cursor()
+    prefix = ('EXPLAIN QUERY PLAN ' if backend.name == 'sqlite'
+        else 'EXPLAIN ')
+    plans = []
+    for query in Report._get_queries(data['direction'],
+            Report.get_roots(data), data['from_date'], data['to_date'],
+            transaction.context.get('company')):
+        sql, params = tuple(query)
+        cursor.execute(prefix + sql, params)
+        plans.append('\n'.join(' '.join(str(c) for c in r) for r in cursor))
+    return plans
+
+
+def measure(function, data, repeat):
+    "Return the median time, the queries and the peak memory of function"
+    transaction = Transaction()
+    times = []
+    for _ in range(repeat):
+        transaction.cache.clear()
+        start = time.perf_counter()
+        function(data)
+        times.append(time.perf_counter() - start)
+
+    queries = [0]
+
+    def count():
+        queries[0] += 1
+    transaction.cache.clear()
+    tracemalloc.start()
+    try:
+        with count_queries(transaction.connection, count):
+            function(data)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return statistics.median(times), queries[0], peak
+
+
+def main(args=None):
+    options = parse_arguments(args)
+    # The report shows the expiration date of the lots
+    activate_module([MODULE, 'stock_lot', 'stock_lot_sled'])
+
+    from trytond.modules.company.tests import create_company, set_company
+    from trytond.modules.production_traceability_report import production
+
+    with Transaction().start(DB_NAME, USER, context={
+                '_request': {'scheme': 'http', 'http_host': 'localhost'},
+                }) as transaction:
+        company = create_company()
+        with set_company(company):
+            start = time.perf_counter()
+            levels, lots = create_factory(options)
+            print("Factory created in %.1fs" % (time.perf_counter() - start),
+                file=sys.stderr)
+
+            results = []
+            header = '%-8s %-22s %-12s %10s %8s %10s' % ('engine', 'case',
+                'stage', 'time (ms)', 'queries', 'peak (KiB)')
+            print(header)
+            print('-' * len(header))
+            for engine in options.engine or [production.ENGINE]:
+                production.ENGINE = engine
+                for name, data in get_cases(options, levels, lots):
+                    if options.explain and engine != 'python':
+                        for plan in explain(data):
+                            print(plan, file=sys.stderr)
+                    for stage, function in get_stages():
+                        wall, queries, peak = measure(function, data,
+                            options.repeat)
+                        print('%-8s %-22s %-12s %10.1f %8s %10.1f' % (
+                                engine, name, stage, wall * 1000, queries,
+                                peak / 1024))
+                        results.append({
+                                'engine': engine,
+                                'case': name,
+                                'stage': stage,
+                                'time': wall,
+                                'queries': queries,
+                                'peak': peak,
+                                })
+        transaction.rollback()
+
+    if options.json_file:
+        with open(options.json_file, 'w') as fp:
+            json.dump({
+                    'options': vars(options),
+                    'results': results,
+                    }, fp, indent=2, default=str)
+
+
+if __name__ == '__main__':
+    main()
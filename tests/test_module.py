@@ -1,9 +1,122 @@
-
 # This file is part of Tryton.  The COPYRIGHT file at the top level of
 # this repository contains the full copyright notices and license terms.
+import datetime
+import html
+import json
+import re
+from decimal import Decimal
+from unittest.mock import patch
+from urllib.parse import parse_qs, urlsplit
+
+from trytond.modules.company.tests import (
+    CompanyTestMixin, create_company, set_company)
+from trytond.pool import Pool
+from trytond.modules.production_traceability_report import (
+    production as production_module, snapshot as snapshot_module, stats)
+from trytond.tests.test_tryton import ModuleTestCase, with_transaction
+from trytond.transaction import Transaction, without_check_access
+
+
+def create_product(name):
+    "Create a goods product in units with a list price"
+    pool = Pool()
+    ModelData = pool.get('ir.model.data')
+    Template = pool.get('product.template')
+    template, = Template.create([{
+                'name': name,
+                'type': 'goods',
+                'producible': True,
+                'default_uom': ModelData.get_id('product', 'uom_unit'),
+                'list_price': Decimal(10),
+                'products': [('create', [{}])],
+                }])
+    return template.products[0]
+
+
+def create_lot(product, number):
+    Lot = Pool().get('stock.lot')
+    lot, = Lot.create([{
+                'number': number,
+                'product': product.id,
+                }])
+    return lot
+
+
+def create_production(company, inputs, outputs):
+    """
+    Create a draft production consuming the inputs and producing the outputs
+    given as (product, lot, quantity)
+    """
+    pool = Pool()
+    Location = pool.get('stock.location')
+    Production = pool.get('production')
+
+    warehouse, = Location.search([('type', '=', 'warehouse')], limit=1)
+    storage = warehouse.storage_location
+    location = warehouse.production_location
 
-from trytond.modules.company.tests import CompanyTestMixin
-from trytond.tests.test_tryton import ModuleTestCase
+    def moves(values, from_location, to_location, price):
+        return [{
+                'product': product.id,
+                'lot': lot.id if lot else None,
+                'unit': product.default_uom.id,
+                'quantity': quantity,
+                'from_location': from_location.id,
+                'to_location': to_location.id,
+                'company': company.id,
+                'unit_price': Decimal(0) if price else None,
+                'currency': company.currency.id if price else None,
+                } for product, lot, quantity in values]
+
+    production, = Production.create([{
+                'company': company.id,
+                'warehouse': warehouse.id,
+                'location': location.id,
+                'inputs': [('create', moves(inputs, storage, location,
+                                False))],
+                'outputs': [('create', moves(outputs, location, storage,
+                                True))],
+                }])
+    return production
+
+
+def process_production(production):
+    "Run the production through its whole workflow"
+    Production = Pool().get('production')
+    Production.wait([production])
+    Production.assign([production])
+    Production.run([production])
+    Production.do([production])
+
+
+def create_factory(company):
+    '''
+    Create the done productions of two levels:
+        flour F1 and water W1 to dough D1
+        dough D1 to bread B1
+        dough D1 and flour F2 to bread B2 and crumbs C1
+    and return the products, lots and productions by name
+    '''
+    records = {}
+    for name in ['flour', 'water', 'dough', 'bread', 'crumbs']:
+        records[name] = create_product(name.capitalize())
+    for number, name in [('F1', 'flour'), ('F2', 'flour'), ('W1', 'water'),
+            ('D1', 'dough'), ('B1', 'bread'), ('B2', 'bread'),
+            ('C1', 'crumbs')]:
+        records[number] = create_lot(records[name], number)
+
+    def line(number, quantity):
+        lot = records[number]
+        return lot.product, lot, quantity
+    for name, inputs, outputs in [
+            ('P1', [line('F1', 10), line('W1', 2)], [line('D1', 12)]),
+            ('P2', [line('D1', 6)], [line('B1', 5)]),
+            ('P3', [line('D1', 6), line('F2', 1)],
+                [line('B2', 5), line('C1', 1)]),
+            ]:
+        records[name] = create_production(company, inputs, outputs)
+        process_production(records[name])
+    return records
 
 
 class ProductionTraceabilityReportTestCase(CompanyTestMixin, ModuleTestCase):
@@ -11,5 +124,574 @@ class ProductionTraceabilityReportTestCase(CompanyTestMixin, ModuleTestCase):
     module = 'production_traceability_report'
     extras = ['stock_lot']
 
+    @with_transaction()
+    def test_workflow_edges(self):
+        "Test the edges written by the production workflow"
+        pool = Pool()
+        Production = pool.get('production')
+        Edge = pool.get('production.traceability.edge')
+
+        company = create_company()
+        with set_company(company):
+            flour = create_product('Flour')
+            bread = create_product('Bread')
+            flour_lot = create_lot(flour, 'F1')
+            bread_lot = create_lot(bread, 'B1')
+            production = create_production(company,
+                [(flour, flour_lot, 10)], [(bread, bread_lot, 5)])
+
+            Production.wait([production])
+            Production.assign([production])
+            Production.run([production])
+            self.assertEqual(Edge.search([]), [])
+
+            Production.do([production])
+            production = Production(production.id)
+            edge, = Edge.search([])
+            self.assertEqual(edge.production, production)
+            self.assertEqual(edge.company, company)
+            self.assertEqual(edge.effective_date, production.effective_date)
+            self.assertEqual(edge.input_product, flour)
+            self.assertEqual(edge.input_lot, flour_lot)
+            self.assertEqual(edge.input_quantity, 10)
+            self.assertEqual(edge.output_product, bread)
+            self.assertEqual(edge.output_lot, bread_lot)
+            self.assertEqual(edge.output_quantity, 5)
+
+    @with_transaction()
+    def test_cache_running_production(self):
+        "Test the cached report is cleared by the moves of a running production"
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company), \
+                Transaction().set_context(_request={
+                        'scheme': 'http',
+                        'http_host': 'localhost',
+                        }):
+            flour = create_product('Flour')
+            bread = create_product('Bread')
+            flour_lot = create_lot(flour, 'F1')
+            production = create_production(company,
+                [(flour, flour_lot, 10)], [(bread, None, 4)])
+            Production.wait([production])
+            Production.assign([production])
+            Production.run([production])
+            data = {
+                'direction': 'forward',
+                'depth': 1,
+                'product': flour.id,
+                'lot': flour_lot.id,
+                'from_date': None,
+                'to_date': None,
+                }
+
+            def quantity():
+                (section,), _ = Report.prepare(data)
+                return section['totals'][bread.id]['quantity']
+            self.assertEqual(quantity(), 4)
+
+            output, = production.outputs
+            Move.write([output], {'quantity': 7})
+            self.assertEqual(quantity(), 7)
+
+    @with_transaction()
+    def test_details_token(self):
+        "Test the signed token of the lazy details"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company), \
+                Transaction().set_context(_request={
+                        'scheme': 'http',
+                        'http_host': 'localhost',
+                        }), \
+                patch.multiple(production_module, DETAILS='lazy',
+                    SECRET='secret', DETAILS_PAGE_SIZE=1, CACHE_SIZE=0):
+            records = create_factory(company)
+            data = {
+                'direction': 'forward',
+                'depth': 1,
+                'product': records['dough'].id,
+                'lot': records['D1'].id,
+                'from_date': None,
+                'to_date': None,
+                }
+            (section,), _ = Report.prepare(data)
+            query = parse_qs(urlsplit(section['details_url']).query)
+            token, = query['token']
+
+            details = Report.details_data(token)
+            self.assertEqual(details['product'], records['dough'].id)
+            self.assertEqual(details['lot'], records['D1'].id)
+            self.assertEqual(details['company'], company.id)
+
+            payload, signature = token.split('.')
+            tampered = '%s.%s' % (payload, signature[::-1])
+            with self.assertRaisesRegex(ValueError, 'Invalid token'):
+                Report.details_data(tampered)
+            with patch.object(production_module, 'SECRET', 'other'):
+                with self.assertRaisesRegex(ValueError, 'Invalid token'):
+                    Report.details_data(token)
+
+            expired = Report._details_token(dict(details, expire=0))
+            with self.assertRaisesRegex(ValueError, 'Expired token'):
+                Report.details_data(expired)
+            with self.assertRaisesRegex(ValueError, 'Expired token'):
+                Report.details(expired, records['bread'].id)
+
+    @with_transaction()
+    def test_details_pages(self):
+        "Test the pages of the lazy details"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company), \
+                Transaction().set_context(_request={
+                        'scheme': 'http',
+                        'http_host': 'localhost',
+                        }), \
+                patch.multiple(production_module, DETAILS='lazy',
+                    SECRET='secret', DETAILS_PAGE_SIZE=1, CACHE_SIZE=0):
+            records = create_factory(company)
+            data = {
+                'direction': 'forward',
+                'depth': 1,
+                'product': records['dough'].id,
+                'lot': records['D1'].id,
+                'from_date': None,
+                'to_date': None,
+                }
+            (section,), _ = Report.prepare(data)
+            token, = parse_qs(urlsplit(section['details_url']).query)['token']
+            bread = records['bread'].id
+
+            first = Report.details(token, bread)
+            self.assertIn('B1', first)
+            self.assertNotIn('B2', first)
+            href, = re.findall(r'class="next-page[^"]*" href="([^"]*)"',
+                first)
+            query = parse_qs(urlsplit(html.unescape(href)).query)
+            self.assertEqual(query, {
+                    'token': [token],
+                    'product': [str(bread)],
+                    'offset': ['1'],
+                    })
+
+            second = Report.details(token, bread, offset=1)
+            self.assertIn('B2', second)
+            self.assertNotIn('B1', second)
+            self.assertNotIn('next-page', second)
+
+            with patch.object(production_module, 'DETAILS_PAGE_SIZE', 2):
+                both = Report.details(token, bread)
+            self.assertIn('B1', both)
+            self.assertIn('B2', both)
+            self.assertNotIn('next-page', both)
+
+    @with_transaction()
+    def test_yield_query(self):
+        "Test the yield of the productions against their BOM"
+        pool = Pool()
+        Production = pool.get('production')
+        Bom = pool.get('production.bom')
+        Report = pool.get('production.traceability.report', type='report')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company):
+            flour = create_product('Flour')
+            bread = create_product('Bread')
+            flour_lot = create_lot(flour, 'F1')
+            unit = flour.default_uom.id
+            bom, = Bom.create([{
+                        'name': 'Bread',
+                        'inputs': [('create', [{
+                                        'product': flour.id,
+                                        'unit': unit,
+                                        'quantity': 10,
+                                        }])],
+                        'outputs': [('create', [{
+                                        'product': bread.id,
+                                        'unit': unit,
+                                        'quantity': 5,
+                                        }])],
+                        }])
+            # Two productions follow the BOM and the last one without BOM
+            # consumes more per unit produced
+            for produced, with_bom in [(5, True), (5, True), (4, False)]:
+                production = create_production(company,
+                    [(flour, flour_lot, 10)], [(bread, None, produced)])
+                if with_bom:
+                    Production.write([production], {
+                            'product': bread.id,
+                            'bom': bom.id,
+                            'unit': unit,
+                            'quantity': produced,
+                            })
+                process_production(production)
+
+            def yields(tolerance):
+                query, = Report._get_queries('forward',
+                    [(flour.id, flour_lot.id)], None, None, company.id)
+                cursor.execute(*Production.traceability_yield_query(
+                        'forward', query, tolerance))
+                return cursor.fetchall()
+
+            (key_product, key_lot, product, productions, produced, consumed,
+                    expected, expected_consumed, minimum, maximum,
+                    outliers), = yields(0.1)
+            self.assertEqual(
+                (key_product, key_lot, product), (flour.id, flour_lot.id,
+                    bread.id))
+            self.assertEqual(productions, 3)
+            self.assertEqual(produced, 14)
+            self.assertEqual(consumed, 30)
+            self.assertEqual(expected, 20)
+            self.assertEqual(expected_consumed, 20)
+            self.assertAlmostEqual(minimum, 2)
+            self.assertAlmostEqual(maximum, 2.5)
+            # The overall consumption is 30 / 14 so only the last production
+            # is outside of 10% and all of them are outside of 5%
+            self.assertEqual(outliers, 1)
+            self.assertEqual(yields(0.2)[0][-1], 0)
+            self.assertEqual(yields(0.05)[0][-1], 3)
+
+    @with_transaction()
+    def test_export(self):
+        "Test the export of both directions"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            flour = create_product('Flour')
+            bread = create_product('Bread')
+            flour_lot = create_lot(flour, 'F1')
+            bread_lot = create_lot(bread, 'B1')
+            production = create_production(company,
+                [(flour, flour_lot, 10)], [(bread, bread_lot, 4)])
+            process_production(production)
+
+            for direction, product, lot, values in [
+                    ('forward', flour, flour_lot, {
+                            'requested_product': flour.rec_name,
+                            'requested_lot': flour_lot.rec_name,
+                            'product': bread.rec_name,
+                            'lot': bread_lot.rec_name,
+                            }),
+                    ('backward', bread, bread_lot, {
+                            'requested_product': bread.rec_name,
+                            'requested_lot': bread_lot.rec_name,
+                            'product': flour.rec_name,
+                            'lot': flour_lot.rec_name,
+                            }),
+                    ]:
+                with self.subTest(direction=direction):
+                    lines = ''.join(Report.export({
+                                'output_format': 'jsonl',
+                                'mode': 'traceability',
+                                'direction': direction,
+                                'product': product.id,
+                                'lot': lot.id,
+                                }))
+                    row, = map(json.loads, lines.splitlines())
+                    self.assertEqual(row, dict(values,
+                            production=production.rec_name,
+                            quantity=4, quantity_uom='u',
+                            consumption=10, consumption_uom='u'))
+
+    @with_transaction()
+    def test_export_chunks(self):
+        "Test the exports only read the rows of the lines consumed"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+            iter_rows = Report._iter_rows
+            read = []
+
+            def counted_rows(*args, **kwargs):
+                for row in iter_rows(*args, **kwargs):
+                    read.append(row)
+                    yield row
+            with patch.object(production_module, 'EXPORT_CHUNK_SIZE', 1), \
+                    patch.object(Report, '_iter_rows', counted_rows):
+                lines = Report.export({
+                        'output_format': 'csv',
+                        'mode': 'traceability',
+                        'direction': 'forward',
+                        'depth': 2,
+                        'product': records['flour'].id,
+                        })
+                header, row = next(lines).splitlines()
+                self.assertEqual(len(read), 1)
+                self.assertEqual(len(list(lines)), len(read) - 1)
+
+                del read[:]
+                graph = Report.export({
+                        'output_format': 'dot',
+                        'mode': 'traceability',
+                        'direction': 'forward',
+                        'depth': 2,
+                        'product': records['flour'].id,
+                        })
+                next(graph)
+                self.assertEqual(len(read), 1)
+                self.assertIn('->', ''.join(graph))
+
+    @with_transaction()
+    def test_store_stats(self):
+        "Test the statistics stored from a read-only transaction"
+        pool = Pool()
+        Stat = pool.get('production.traceability.stat')
+        TraceabilityStats = stats.TraceabilityStats
+
+        transaction = Transaction()
+        with patch.object(stats, 'STORE', True):
+            with transaction.new_transaction(readonly=True), \
+                    TraceabilityStats.record('Test', engine='sql'):
+                with TraceabilityStats.stage('rows'):
+                    TraceabilityStats.add_rows(3)
+
+        with transaction.new_transaction(), without_check_access():
+            stat, = Stat.search([('name', '=', 'Test')])
+            self.assertEqual(stat.engine, 'sql')
+            self.assertEqual(stat.rows, 3)
+            self.assertEqual(stat.duration, round(stat.duration, 3))
+            stage, = stat.stages
+            self.assertEqual(stage.name, 'rows')
+            self.assertEqual(stage.rows, 3)
+            Stat.delete([stat])
+
+    @with_transaction()
+    def test_engines(self):
+        "Test the engines return the same rows"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+
+            for direction, product, lot in [
+                    ('forward', 'flour', 'F1'),
+                    ('forward', 'flour', None),
+                    ('backward', 'bread', 'B2'),
+                    ('backward', 'bread', None),
+                    ]:
+                roots = [(records[product].id,
+                        records[lot].id if lot else None)]
+                rows = {}
+                for engine in ['edge', 'sql', 'python']:
+                    with patch.object(production_module, 'ENGINE', engine):
+                        rows[engine] = sorted(Report._iter_rows(direction,
+                                roots, 2, None, None, company.id))
+                with self.subTest(direction=direction, lot=lot):
+                    self.assertTrue(rows['sql'])
+                    self.assertEqual(rows['edge'], rows['sql'])
+                    self.assertEqual(rows['python'], rows['sql'])
+
+    @with_transaction()
+    def test_snapshot_refresh(self):
+        "Test the refresh of a snapshot"
+        pool = Pool()
+        Snapshot = pool.get('production.traceability.snapshot')
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+            data = {
+                'direction': 'forward',
+                'depth': 2,
+                'product': records['flour'].id,
+                'lot': records['F1'].id,
+                'products': [],
+                'lots': [],
+                'from_date': None,
+                'to_date': None,
+                }
+            snapshot = Snapshot.create_from_data(data)
+
+            def rows(snapshot=None):
+                return sorted(Report._iter_rows('forward',
+                        Report.get_roots(data), 2, None, None, company.id,
+                        snapshot=snapshot))
+            self.assertEqual(rows(snapshot.id), rows())
+
+            bread_lot = create_lot(records['bread'], 'B3')
+            production = create_production(company,
+                [(records['dough'], records['D1'], 3)],
+                [(records['bread'], bread_lot, 2)])
+            process_production(production)
+            self.assertNotEqual(rows(snapshot.id), rows())
+
+            Snapshot.refresh([snapshot])
+            self.assertEqual(rows(snapshot.id), rows())
+
+    @with_transaction()
+    def test_snapshot_refresh_deleted_move(self):
+        "Test the refresh of a snapshot after the deletion of a move"
+        pool = Pool()
+        Production = pool.get('production')
+        Move = pool.get('stock.move')
+        Snapshot = pool.get('production.traceability.snapshot')
+        Report = pool.get('production.traceability.report', type='report')
+        cursor = Transaction().connection.cursor()
+
+        company = create_company()
+        with set_company(company), patch.object(snapshot_module, 'MARGIN', 0):
+            flour = create_product('Flour')
+            bread = create_product('Bread')
+            crumbs = create_product('Crumbs')
+            flour_lot = create_lot(flour, 'F1')
+            production = create_production(company,
+                [(flour, flour_lot, 10)],
+                [(bread, create_lot(bread, 'B1'), 8),
+                    (crumbs, create_lot(crumbs, 'C1'), 1)])
+            Production.wait([production])
+            Production.assign([production])
+            Production.run([production])
+            data = {
+                'direction': 'forward',
+                'depth': 1,
+                'product': flour.id,
+                'lot': flour_lot.id,
+                'products': [],
+                'lots': [],
+                'from_date': None,
+                'to_date': None,
+                }
+            snapshot = Snapshot.create_from_data(data)
+
+            # Age the moves and the productions behind the watermark
+            past = datetime.datetime(2000, 1, 1)
+            for Model in [Move, Production]:
+                table = Model.__table__()
+                cursor.execute(*table.update(
+                        [table.create_date, table.write_date], [past, past]))
+            table = Snapshot.__table__()
+            cursor.execute(*table.update(
+                    [table.last_write], [past + datetime.timedelta(days=1)],
+                    where=table.id == snapshot.id))
+            snapshot = Snapshot(snapshot.id)
+
+            def rows(snapshot=None):
+                return sorted(Report._iter_rows('forward',
+                        Report.get_roots(data), 1, None, None, company.id,
+                        snapshot=snapshot))
+            self.assertEqual(rows(snapshot.id), rows())
+
+            output, = [m for m in production.outputs if m.product == crumbs]
+            Move.delete([output])
+            self.assertNotEqual(rows(snapshot.id), rows())
+
+            Snapshot.refresh([snapshot])
+            self.assertEqual(rows(snapshot.id), rows())
+
+    @with_transaction()
+    def test_traceability_lots(self):
+        "Test the lots traced in both directions"
+        pool = Pool()
+        Production = pool.get('production')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+            r = records
+
+            self.assertEqual(sorted(Production.traceability_lots(
+                        [r['F1'].id], 'forward', depth=2)), sorted([
+                        (r['F1'].id, r['D1'].id, r['dough'].id, r['P1'].id,
+                            12, None, 1),
+                        (r['D1'].id, r['B1'].id, r['bread'].id, r['P2'].id,
+                            5, None, 2),
+                        (r['D1'].id, r['B2'].id, r['bread'].id, r['P3'].id,
+                            5, None, 2),
+                        (r['D1'].id, r['C1'].id, r['crumbs'].id, r['P3'].id,
+                            1, None, 2),
+                        ]))
+            self.assertEqual(sorted(Production.traceability_lots(
+                        [r['B2'].id], 'backward', depth=2)), sorted([
+                        (r['B2'].id, r['D1'].id, r['dough'].id, r['P3'].id,
+                            6, None, 1),
+                        (r['B2'].id, r['F2'].id, r['flour'].id, r['P3'].id,
+                            1, None, 1),
+                        (r['D1'].id, r['F1'].id, r['flour'].id, r['P1'].id,
+                            10, None, 2),
+                        (r['D1'].id, r['W1'].id, r['water'].id, r['P1'].id,
+                            2, None, 2),
+                        ]))
+            self.assertEqual(len(Production.traceability_lots(
+                        [r['F1'].id], 'forward', depth=2, limit=2)), 2)
+
+    @with_transaction()
+    def test_traceability_lots_limit(self):
+        "Test the limit of the lots stops reading the rows"
+        pool = Pool()
+        Production = pool.get('production')
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+            iter_rows = Report._iter_rows
+            read = []
+
+            def counted_rows(*args, **kwargs):
+                for row in iter_rows(*args, **kwargs):
+                    read.append(row)
+                    yield row
+            with patch.object(production_module, 'EXPORT_CHUNK_SIZE', 1), \
+                    patch.object(Report, '_iter_rows', counted_rows):
+                lots = Production.traceability_lots(
+                    [records['F1'].id], 'forward', depth=5, limit=1)
+            self.assertEqual(len(lots), 1)
+            self.assertEqual(len(read), 1)
+
+    @with_transaction()
+    def test_stream_render(self):
+        "Test the streamed report is the same as the built one"
+        pool = Pool()
+        Report = pool.get('production.traceability.report', type='report')
+
+        company = create_company()
+        with set_company(company):
+            records = create_factory(company)
+            data = {
+                'direction': 'forward',
+                'depth': 2,
+                'output_format': 'html',
+                'from_date': None,
+                'to_date': None,
+                'product': records['flour'].id,
+                'products': [records['water'].id],
+                'lot': None,
+                'lots': [],
+                'model': None,
+                'ids': [],
+                }
+            for html in ['bootstrap', 'lite']:
+                contents = {}
+                for render in ['dom', 'stream']:
+                    with patch.object(production_module, 'HTML', html), \
+                            patch.object(production_module, 'RENDER', render), \
+                            Transaction().set_context(_request={
+                                    'scheme': 'http',
+                                    'http_host': 'localhost',
+                                    }):
+                        _, contents[render], _, _ = Report.execute([], data)
+                with self.subTest(html=html):
+                    self.assertIn(records['B2'].rec_name, contents['dom'])
+                    self.assertEqual(contents['stream'], contents['dom'])
+
 
 del ModuleTestCase
@@ -0,0 +1,268 @@
+# The COPYRIGHT file at the top level of this repository contains the full
+# copyright notices and license terms.
+from sql import Cast, Literal, Null
+from sql.aggregate import Max, Sum
+from sql.functions import CurrentTimestamp
+
+from trytond import backend
+from trytond.model import fields, Index, ModelSQL, ModelView
+from trytond.pool import Pool, PoolMeta
+from trytond.pyson import Eval
+from trytond.tools import grouped_slice, reduce_ids
+from trytond.transaction import Transaction
+from trytond.wizard import Button, StateTransition, StateView, Wizard
+
+
+class TraceabilityEdge(ModelSQL, ModelView):
+    'Production Traceability Edge'
+    __name__ = 'production.traceability.edge'
+    production = fields.Many2One('production', 'Production', required=True,
+        ondelete='CASCADE', readonly=True)
+    company = fields.Many2One('company.company', 'Company', required=True,
+        readonly=True)
+    effective_date = fields.Date('Effective Date', readonly=True)
+    input_product = fields.Many2One('product.product', 'Input Product',
+        required=True, readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    input_quantity = fields.Float('Input Quantity', readonly=True,
+        help='Quantity in the default UoM of the input product.')
+    output_product = fields.Many2One('product.product', 'Output Product',
+        required=True, readonly=True,
+        context={
+            'company': Eval('company', -1),
+            },
+        depends=['company'])
+    output_quantity = fields.Float('Output Quantity', readonly=True,
+        help='Quantity in the default UoM of the output product.')
+
+    @classmethod
+    def __setup__(cls):
+        super(TraceabilityEdge, cls).__setup__()
+        try:
+            Lot = Pool().get('stock.lot')
+        except:
+            Lot = None
+        if Lot:
+            cls.input_lot = fields.Many2One('stock.lot', 'Input Lot',
+                readonly=True)
+            cls.output_lot = fields.Many2One('stock.lot', 'Output Lot',
+                readonly=True)
+
+        t = cls.__table__()
+        input_lot = [(t.input_lot, Index.Range())] if Lot else []
+        output_lot = [(t.output_lot, Index.Range())] if Lot else []
+        cls._sql_indexes.update({
+                Index(t, (t.production, Index.Range())),
+                Index(t, (t.output_product, Index.Range()), *output_lot,
+                    (t.effective_date, Index.Range())),
+                Index(t, (t.input_product, Index.Range()), *input_lot,
+                    (t.effective_date, Index.Range())),
+                })
+        cls._order.insert(0, ('effective_date', 'DESC'))
+
+    @classmethod
+    def __register__(cls, module_name):
+        exist = backend.TableHandler.table_exist(cls._table)
+
+        super(TraceabilityEdge, cls).__register__(module_name)
+
+        # Backfill the edges of the existing productions
+        if not exist:
+            cls._insert_edges()
+
+    @classmethod
+    def _insert_edges(cls, production_ids=None):
+        "Insert the edges of the done productions"
+        pool = Pool()
+        Production = pool.get('production')
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        production = Production.__table__()
+        has_lot = hasattr(cls, 'input_lot')
+
+        sides = []
+        for side in ['production_input', 'production_output']:
+            move, from_, quantity = Production._traceability_moves()
+            where = move.state == 'done'
+            if production_ids is not None:
+                where &= reduce_ids(getattr(move, side), production_ids)
+            columns = [getattr(move, side), move.product]
+            if has_lot:
+                columns.append(move.lot)
+            sides.append(from_.select(
+                    getattr(move, side).as_('production'),
+                    move.product.as_('product'),
+                    (move.lot if has_lot else Cast(Null, 'INTEGER')
+                        ).as_('lot'),
+                    Sum(quantity).as_('quantity'),
+                    where=where,
+                    group_by=columns))
+        inputs, outputs = sides
+
+        columns = [table.create_uid, table.create_date, table.production,
+            table.company, table.effective_date,
+            table.input_product, table.input_quantity,
+            table.output_product, table.output_quantity]
+        values = [Literal(transaction.user), CurrentTimestamp(),
+            production.id, production.company, production.effective_date,
+            inputs.product, inputs.quantity,
+            outputs.product, outputs.quantity]
+        if has_lot:
+            columns += [table.input_lot, table.output_lot]
+            values += [inputs.lot, outputs.lot]
+        query = (inputs
+            .join(outputs, condition=inputs.production == outputs.production)
+            .join(production, condition=inputs.production == production.id)
+            .select(*values, where=production.state == 'done'))
+        cursor.execute(*table.insert(columns, query))
+
+    @classmethod
+    def update_productions(cls, productions):
+        "Replace the edges of the productions by their current moves"
+        Report = Pool().get('production.traceability.report', type='report')
+        Report.clear_cache()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice([p.id for p in productions]):
+            sub_ids = list(sub_ids)
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.production, sub_ids)))
+            cls._insert_edges(sub_ids)
+
+    @classmethod
+    def delete_productions(cls, productions):
+        Report = Pool().get('production.traceability.report', type='report')
+        Report.clear_cache()
+        transaction = Transaction()
+        cursor = transaction.connection.cursor()
+        table = cls.__table__()
+        for sub_ids in grouped_slice([p.id for p in productions]):
+            cursor.execute(*table.delete(
+                    where=reduce_ids(table.production, sub_ids)))
+
+    @classmethod
+    def rebuild(cls):
+        "Rebuild the edges of all the done productions"
+        Report = Pool().get('production.traceability.report', type='report')
+        Report.clear_cache()
+        cursor = Transaction().connection.cursor()
+        table = cls.__table__()
+        cursor.execute(*table.delete())
+        cls._insert_edges()
+
+    @classmethod
+    def traceability_query(cls, direction, products=None, lots=None,
+            from_date=None, to_date=None, company=None, productions=None):
+        '''
+        Return the same rows as Production.traceability_query read from
+        the edges
+        '''
+        has_lot = hasattr(cls, 'input_lot')
+        if direction == 'backward':
+            side, other = 'output', 'input'
+        else:
+            side, other = 'input', 'output'
+
+        matched = None
+        for field, ids in (('product', products), ('lot', lots)):
+            if not ids or (field == 'lot' and not has_lot):
+                continue
+            edge = cls.__table__()
+            where = getattr(edge, '%s_%s' % (side, field)).in_(ids)
+            if company is not None:
+                where &= (edge.company == company)
+            if from_date:
+                where &= (edge.effective_date >= from_date)
+            if to_date:
+                where &= (edge.effective_date <= to_date)
+            if productions is not None:
+                where &= reduce_ids(edge.production, productions)
+            lot = (getattr(edge, side + '_lot') if field == 'lot'
+                else Cast(Null, 'INTEGER'))
+            query = edge.select(
+                edge.production.as_('production'),
+                getattr(edge, side + '_product').as_('product'),
+                lot.as_('lot'),
+                where=where,
+                distinct=True)
+            matched = query if matched is None else matched | query
+        assert matched is not None, 'products or lots are required'
+
+        # The side quantity is repeated on each edge of the other side
+        edge = cls.__table__()
+        side_lot = getattr(edge, side + '_lot') if has_lot else Null
+        group_by = [edge.production, getattr(edge, side + '_product')]
+        if has_lot:
+            group_by.append(side_lot)
+        side_lots = edge.select(
+            edge.production.as_('production'),
+            getattr(edge, side + '_product').as_('product'),
+            Max(getattr(edge, side + '_quantity')).as_('quantity'),
+            where=edge.production.in_(matched.select(matched.production)),
+            group_by=group_by)
+        requested = side_lots.select(
+            side_lots.production.as_('production'),
+            side_lots.product.as_('product'),
+            Sum(side_lots.quantity).as_('quantity'),
+            group_by=[side_lots.production, side_lots.product])
+
+        edge = cls.__table__()
+        other_lot = (getattr(edge, other + '_lot') if has_lot
+            else Cast(Null, 'INTEGER'))
+        columns = [matched.product, matched.lot, matched.production,
+            getattr(edge, other + '_product')]
+        if has_lot:
+            columns.append(other_lot)
+        return (edge
+            .join(matched, condition=edge.production == matched.production)
+            .join(requested,
+                condition=((matched.production == requested.production)
+                    & (matched.product == requested.product)))
+            .select(
+                matched.product.as_('key_product'),
+                matched.lot.as_('key_lot'),
+                matched.production.as_('production'),
+                getattr(edge, other + '_product').as_('product'),
+                other_lot.as_('lot'),
+                Max(getattr(edge, other + '_quantity')).as_('quantity'),
+                requested.quantity.as_('requested_quantity'),
+                group_by=columns + [requested.quantity],
+                order_by=[matched.production] + columns[3:]))
+
+
+class Cron(metaclass=PoolMeta):
+    __name__ = 'ir.cron'
+
+    @classmethod
+    def __setup__(cls):
+        super(Cron, cls).__setup__()
+        cls.method.selection.append(
+            ('production.traceability.edge|rebuild',
+                "Rebuild Production Traceability"))
+
+
+class RebuildTraceabilityEdgeStart(ModelView):
+    'Rebuild Production Traceability Start'
+    __name__ = 'production.traceability.edge.rebuild.start'
+
+
+class RebuildTraceabilityEdge(Wizard):
+    'Rebuild Production Traceability'
+    __name__ = 'production.traceability.edge.rebuild'
+    start = StateView('production.traceability.edge.rebuild.start',
+        'production_traceability_report.rebuild_traceability_edge_start_view_form', [
+            Button('Cancel', 'end', 'tryton-cancel'),
+            Button('Rebuild', 'rebuild', 'tryton-ok', default=True),
+            ])
+    rebuild = StateTransition()
+
+    def transition_rebuild(self):
+        pool = Pool()
+        Edge = pool.get('production.traceability.edge')
+        Edge.rebuild()
+        return 'end'